@@ -0,0 +1,63 @@
+"""
+Checks that concurrent /query calls overlap instead of queueing behind each other.
+
+Runs the app against the fake completion server, times one request, then N at
+once. With a non-blocking agent loop both numbers should be about the same.
+Exits non-zero if the concurrent batch takes more than twice a single request.
+
+    python benchmarks/bench_concurrency.py [--concurrency 10] [--delay 0.5]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import create_fake_openai_app, free_port, serve_in_thread
+
+SAMPLE_DATA = '[{"origin": "USA", "mpg": 18}, {"origin": "Europe", "mpg": 26}]'
+
+
+async def timed_queries(base_url, n):
+    #Distinct prompts so the response cache can't merge the requests
+    payloads = [{"prompt": f"what is the average mpg? ({time.time()} {i})", "sample_data": SAMPLE_DATA} for i in range(n)]
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(http.post("/query", json=payload) for payload in payloads))
+        elapsed = time.perf_counter() - start
+    for response in responses:
+        response.raise_for_status()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    fake_port = free_port()
+    serve_in_thread(create_fake_openai_app(delay=args.delay), fake_port)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{fake_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "fake"
+
+    import main as app_module
+
+    app_port = free_port()
+    serve_in_thread(app_module.app, app_port)
+    base_url = f"http://127.0.0.1:{app_port}"
+
+    single = asyncio.run(timed_queries(base_url, 1))
+    batch = asyncio.run(timed_queries(base_url, args.concurrency))
+    ratio = batch / single
+    print(f"1 request:            {single:.3f}s")
+    print(f"{args.concurrency} concurrent requests: {batch:.3f}s ({ratio:.2f}x a single request)")
+    sys.exit(0 if ratio < 2 else 1)
+
+
+if __name__ == "__main__":
+    main()
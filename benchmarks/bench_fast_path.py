@@ -0,0 +1,71 @@
+"""
+Share of recorded questions answered by the fast path in under 50 ms.
+
+Runs the app against the fake completion server (so questions that reach the
+agent take at least one --delay), uploads a generated cars-like CSV and sends
+every question in recorded_queries.json once, one at a time.
+
+    python benchmarks/bench_fast_path.py [--rows 100000] [--delay 0.5] [--threshold-ms 50]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import create_fake_openai_app, free_port, serve_in_thread
+from bench_load import make_cars_csv
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--threshold-ms", type=float, default=50)
+    parser.add_argument("--queries", default=os.path.join(BENCH_DIR, "recorded_queries.json"))
+    args = parser.parse_args()
+
+    with open(args.queries) as f:
+        questions = json.load(f)
+
+    workdir = tempfile.mkdtemp()
+    fake_port = free_port()
+    serve_in_thread(create_fake_openai_app(delay=args.delay), fake_port)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{fake_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["DATASET_DIR"] = os.path.join(workdir, "datasets")
+
+    import main as app_module
+
+    app_port = free_port()
+    serve_in_thread(app_module.app, app_port)
+
+    csv_path = os.path.join(workdir, "cars.csv")
+    make_cars_csv(args.rows, csv_path)
+    with httpx.Client(base_url=f"http://127.0.0.1:{app_port}", timeout=120) as http:
+        with open(csv_path, "rb") as f:
+            dataset_id = http.post("/upload", files={"file": ("cars.csv", f, "text/csv")}).json()["dataset_id"]
+        #Load the dataset into the app's cache before timing
+        http.post("/query", json={"prompt": "how many rows", "dataset_id": dataset_id})
+
+        fast = 0
+        for question in questions:
+            start = time.perf_counter()
+            response = http.post("/query", json={"prompt": question, "dataset_id": dataset_id})
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            response.raise_for_status()
+            fast += elapsed_ms < args.threshold_ms
+            print(f"{elapsed_ms:8.1f} ms  {question}")
+
+    print(f"{fast}/{len(questions)} questions ({fast / len(questions):.0%}) answered in under {args.threshold_ms:.0f} ms on {args.rows} rows")
+
+
+if __name__ == "__main__":
+    main()
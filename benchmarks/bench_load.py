@@ -0,0 +1,268 @@
+"""
+Load test for /query against the fake completion server.
+
+Starts the fake server replaying transcripts.json and, for each dataset size, a
+fresh app process (uvicorn main:app). It uploads a generated cars-like CSV with
+that many rows, then sends --requests queries at --concurrency, cycling through
+the transcript prompts. Prompts are made unique so the response cache doesn't
+answer them. With --session-turns N every N consecutive prompts are asked one
+after another in one chat session, to measure follow-up questions.
+
+Reports p50/p95/p99 latency, requests per second, peak RSS of the app and its
+code workers, and OpenAI tokens per request (from /metrics, including prompt
+tokens the fake server reports as cached), and writes them to
+a JSON file named after the current commit so runs can be compared.
+
+    python benchmarks/bench_load.py [--rows 1000 10000 100000 1000000] [--concurrency 10]
+        [--requests 100] [--delay 0.2] [--session-turns 1] [--output results.json]
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+import numpy as np
+import pandas as pd
+
+from fake_openai import free_port, load_transcripts
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def make_cars_csv(rows, path, seed=0):
+    rng = np.random.default_rng(seed)
+    origin = rng.choice(["USA", "Europe", "Japan"], size=rows, p=[0.6, 0.2, 0.2])
+    year = rng.integers(1970, 1983, size=rows)
+    weight = rng.normal(3000, 800, size=rows).clip(1600, 5200).round()
+    horsepower = (weight / 30 + rng.normal(0, 15, size=rows)).clip(45, 230).round()
+    mpg = (50 - weight / 120 + (year - 1970) * 0.6 + rng.normal(0, 3, size=rows)).clip(8, 48).round(1)
+    pd.DataFrame({
+        "name": [f"car {i}" for i in range(rows)],
+        "origin": origin,
+        "year": year,
+        "mpg": mpg,
+        "horsepower": horsepower,
+        "weight": weight,
+    }).to_csv(path, index=False)
+
+
+def wait_until_up(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start within {timeout}s")
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child in open(f"/proc/{pid}/task/{pid}/children").read().split():
+        pids += process_tree(int(child))
+    return pids
+
+
+def peak_rss_mb(pid):
+    """Peak resident set size (VmHWM) of a process and of its children, in MB. Linux only."""
+    if not os.path.exists(f"/proc/{pid}"):
+        return None
+    peaks = {}
+    for child in process_tree(pid):
+        try:
+            status = open(f"/proc/{child}/status").read()
+        except FileNotFoundError:
+            continue
+        match = re.search(r"VmHWM:\s+(\d+) kB", status)
+        if match:
+            peaks[child] = int(match.group(1)) / 1024
+    app = peaks.pop(pid, 0.0)
+    return {"app": round(app, 1), "children": round(sum(peaks.values()), 1), "total": round(app + sum(peaks.values()), 1)}
+
+
+def token_totals(metrics_text):
+    totals = {"prompt": 0.0, "completion": 0.0, "cached_prompt": 0.0}
+    for kind, value in re.findall(r'humanai_llm_tokens_total\{model="[^"]*",kind="(\w+)"\} ([0-9.e+]+)', metrics_text):
+        totals[kind] += float(value)
+    return totals
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+async def run_load(base_url, dataset_id, prompts, n_requests, concurrency, session_turns=1):
+    """Returns (first turn latencies, follow-up latencies, errors, elapsed seconds)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = ([], [])
+    errors = 0
+    run_id = time.time()
+
+    async def one(http, i, session_id):
+        nonlocal errors
+        #Unique suffix so every request misses the response cache
+        payload = {"prompt": f"{prompts[i % len(prompts)]} (request {i} {run_id})", "dataset_id": dataset_id, "session_id": session_id}
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await http.post("/query", json=payload)
+                ok = response.status_code == 200 and not response.json()["response"].startswith("An error occurred")
+            except httpx.HTTPError:
+                ok = False
+            latencies[i % session_turns > 0].append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    async def session(http, first):
+        session_id = f"bench-{int(run_id)}-{first}" if session_turns > 1 else None
+        for i in range(first, min(first + session_turns, n_requests)):
+            await one(http, i, session_id)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=httpx.Limits(max_connections=concurrency)) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(session(http, first) for first in range(0, n_requests, session_turns)))
+        elapsed = time.perf_counter() - start
+    return latencies[0], latencies[1], errors, elapsed
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return None
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": float(np.mean(latencies)),
+        "max": float(np.max(latencies)),
+    }
+
+
+def bench_rows(rows, args, fake_url, prompts, workdir):
+    csv_path = os.path.join(workdir, f"cars-{rows}.csv")
+    make_cars_csv(rows, csv_path)
+
+    port = free_port()
+    env = {
+        **os.environ,
+        "OPENAI_BASE_URL": fake_url,
+        "OPENAI_API_KEY": "fake",
+        "DATASET_DIR": os.path.join(workdir, "datasets"),
+        "RESPONSE_CACHE_BACKEND": "memory",
+        "PAYLOAD_LOG_SAMPLE_RATE": "0",
+    }
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_DIR, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_up(f"{base_url}/metrics", app)
+        start = time.perf_counter()
+        with open(csv_path, "rb") as f:
+            upload = httpx.post(f"{base_url}/upload", files={"file": ("cars.csv", f, "text/csv")}, timeout=600)
+        upload.raise_for_status()
+        upload_seconds = time.perf_counter() - start
+        dataset_id = upload.json()["dataset_id"]
+
+        #One round of every prompt first, so worker start-up and first loads aren't measured
+        asyncio.run(run_load(base_url, dataset_id, prompts, len(prompts), len(prompts)))
+        tokens_before = token_totals(httpx.get(f"{base_url}/metrics").text)
+        first_turns, follow_ups, errors, elapsed = asyncio.run(
+            run_load(base_url, dataset_id, prompts, args.requests, args.concurrency, args.session_turns)
+        )
+        tokens_after = token_totals(httpx.get(f"{base_url}/metrics").text)
+        rss = peak_rss_mb(app.pid)
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+
+    return {
+        "rows": rows,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "session_turns": args.session_turns,
+        "errors": errors,
+        "upload_seconds": round(upload_seconds, 3),
+        "latency_seconds": latency_summary(first_turns + follow_ups),
+        "follow_up_latency_seconds": latency_summary(follow_ups),
+        "requests_per_second": args.requests / elapsed,
+        "peak_rss_mb": rss,
+        "tokens_per_request": {kind: (tokens_after[kind] - tokens_before[kind]) / args.requests for kind in tokens_after},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--delay", type=float, default=0.2, help="seconds per fake completion")
+    parser.add_argument("--session-turns", type=int, default=1, help="questions asked in each chat session")
+    parser.add_argument("--transcripts", default=os.path.join(BENCH_DIR, "transcripts.json"))
+    parser.add_argument("--output", help="defaults to benchmarks/results/load-<commit>.json")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = args.output or os.path.join(BENCH_DIR, "results", f"load-{commit}.json")
+    transcripts = load_transcripts(args.transcripts)
+    #A prompt its transcript doesn't match gets the fake server's plain answer and skews the numbers
+    for transcript in transcripts:
+        assert transcript["match"] in transcript["prompt"], f"match {transcript['match']!r} is not in its prompt {transcript['prompt']!r}"
+    prompts = [transcript["prompt"] for transcript in transcripts]
+
+    fake_port = free_port()
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"),
+        "--port", str(fake_port), "--delay", str(args.delay), "--transcripts", args.transcripts,
+    ])
+    fake_url = f"http://127.0.0.1:{fake_port}/v1"
+    results = []
+    try:
+        wait_until_up(f"http://127.0.0.1:{fake_port}/docs", fake)
+        with tempfile.TemporaryDirectory() as workdir:
+            for rows in args.rows:
+                result = bench_rows(rows, args, fake_url, prompts, workdir)
+                results.append(result)
+                latency = result["latency_seconds"]
+                print(
+                    f"{rows:>8} rows: p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  p99 {latency['p99']:.3f}s  "
+                    f"{result['requests_per_second']:.1f} req/s  errors {result['errors']}  "
+                    f"peak RSS {result['peak_rss_mb']['total'] if result['peak_rss_mb'] else '?'} MB  "
+                    f"tokens/request {result['tokens_per_request']['prompt'] + result['tokens_per_request']['completion']:.0f} "
+                    f"({result['tokens_per_request'].get('cached_prompt', 0):.0f} cached)"
+                )
+    finally:
+        fake.terminate()
+        fake.wait(timeout=30)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {"delay": args.delay, "concurrency": args.concurrency, "requests": args.requests,
+                   "session_turns": args.session_turns, "transcripts": os.path.basename(args.transcripts)},
+            "results": results,
+        }, f, indent=2)
+    print(f"wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Validations per second for Vega-Lite specs.
+
+Compares the old path (parse the schema and build a validator for every spec,
+not counting the network download it also did) with the precompiled validator,
+with and without the result cache.
+
+    python benchmarks/bench_validation.py [--seconds 2]
+"""
+import os
+import sys
+import time
+import argparse
+
+from jsonschema import validate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vega_validation
+from vega_validation import load_vega_lite_schema, get_vega_lite_validator, validate_vega_lite_spec, clear_validation_cache
+
+
+def make_spec(i):
+    return {
+        "$schema": "https://vega.github.io/schema/vega-lite/v5.json",
+        "data": {"values": [{"category": c, "value": (i + n) % 7} for n, c in enumerate("ABCDEFGH")]},
+        "mark": "bar",
+        "encoding": {
+            "x": {"field": "category", "type": "nominal"},
+            "y": {"field": "value", "type": "quantitative"},
+        },
+    }
+
+
+def run(label, fn, seconds):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        fn(count)
+        count += 1
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {count / elapsed:>12.1f} validations/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    schema = load_vega_lite_schema()
+    get_vega_lite_validator()
+    specs = [make_spec(i) for i in range(64)]
+
+    run("before: validate() per call", lambda i: validate(instance=specs[i % len(specs)], schema=schema), args.seconds)
+
+    def compiled_uncached(i):
+        clear_validation_cache()
+        validate_vega_lite_spec(specs[i % len(specs)])
+
+    run("after: compiled validator, cold cache", compiled_uncached, args.seconds)
+
+    clear_validation_cache()
+    run("after: compiled validator, warm cache", lambda i: validate_vega_lite_spec(specs[i % len(specs)]), args.seconds)
+    print(f"cache size: {len(vega_validation._validation_cache)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Local stand-in for the OpenAI chat-completions API.
+
+Every completion takes `delay` seconds, like a real model call would. Without
+transcripts it answers with plain text (or a `{"code": ...}` object when a
+response_format is requested), so the agent loop in main.py finishes after one
+round trip. Streaming requests get the text word by word, spread over the same
+delay.
+
+With `transcripts` (see transcripts.json) it replays recorded tool-calling
+conversations instead. A transcript is picked by looking for its "match" text
+in the last user message of the request, so its tool call arguments should
+contain that text too for the code and chart calls to find the same transcript:
+
+    {
+      "match": "average mpg",
+      "prompt": "What is the average mpg?",
+      "agent": [                          # one entry per agent turn, picked by
+        {"tool_calls": [{"name": ..., "arguments": {...}}]},   # the number of
+        {"content": "The average mpg is ...", "delay": 0.2}    # assistant messages since the question
+      ],
+      "code": "print(df['mpg'].mean())",  # answer to the code model
+      "chart": {"vegaSpec": {...}, "response": "..."}          # answer to the chart model
+    }
+
+Usage is estimated at four characters per token, so token counts follow the
+size of the prompts the app sends. Like the real API's prompt caching, the
+longest run of leading messages already seen in an earlier request is reported
+as cached_tokens.
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1, or run it
+on its own with `python benchmarks/fake_openai.py --port 8001 --transcripts benchmarks/transcripts.json`.
+"""
+import json
+import time
+import hashlib
+import uuid
+import socket
+import asyncio
+import argparse
+import threading
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def load_transcripts(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def create_fake_openai_app(delay=0.5, content="This is a fake answer.", code="print('fake')", transcripts=None):
+    app = FastAPI()
+    seen_prefixes = set()
+
+    def current_turn(messages):
+        """Messages from the last user message on, earlier turns of a chat session don't count."""
+        starts = [i for i, m in enumerate(messages) if m.get("role") == "user"]
+        return messages[starts[-1]:] if starts else messages
+
+    def find_transcript(messages):
+        turn = current_turn(messages)
+        text = turn[0].get("content") if turn and isinstance(turn[0].get("content"), str) else ""
+        for transcript in transcripts or []:
+            if transcript["match"] in text:
+                return transcript
+        return None
+
+    def reply(body):
+        """The assistant turn to answer `body` with: (content, tool_calls, delay)."""
+        transcript = find_transcript(body.get("messages", []))
+        if body.get("response_format"):
+            return json.dumps({"code": transcript["code"] if transcript else code}), [], delay
+        if transcript is None:
+            return content, [], delay
+        if not body.get("tools"):
+            chart = transcript.get("chart", {"vegaSpec": {}, "response": content})
+            return json.dumps(chart), [], delay
+        step = sum(1 for m in current_turn(body["messages"]) if m.get("role") == "assistant")
+        turn = transcript["agent"][min(step, len(transcript["agent"]) - 1)]
+        tool_calls = [
+            {
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "function",
+                "function": {"name": call["name"], "arguments": json.dumps(call["arguments"])},
+            }
+            for call in turn.get("tool_calls", [])
+        ]
+        return turn.get("content"), tool_calls, turn.get("delay", delay)
+
+    def cached_tokens(messages):
+        """Tokens of the longest run of leading messages sent before."""
+        cached_count = 0
+        prefix = hashlib.sha256()
+        for count, message in enumerate(messages, 1):
+            prefix.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+            digest = prefix.hexdigest()
+            if digest in seen_prefixes:
+                cached_count = count
+            seen_prefixes.add(digest)
+        return estimate_tokens(json.dumps(messages[:cached_count])) if cached_count else 0
+
+    def usage(body, message_content, tool_calls):
+        prompt_tokens = estimate_tokens(json.dumps(body.get("messages", [])) + json.dumps(body.get("tools", [])))
+        completion_tokens = estimate_tokens((message_content or "") + json.dumps(tool_calls))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens(body.get("messages", []))},
+        }
+
+    def chunk(completion_id, model, delta, finish_reason=None, **extra):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+            **extra,
+        }
+
+    async def stream_words(completion_id, model, text, tool_calls, turn_delay, usage_data):
+        words = text.split(" ") if text else []
+        pieces = len(words) + len(tool_calls)
+        for i, word in enumerate(words):
+            await asyncio.sleep(turn_delay / pieces)
+            delta = {"content": word if i == 0 else " " + word}
+            yield f"data: {json.dumps(chunk(completion_id, model, delta))}\n\n"
+        for index, call in enumerate(tool_calls):
+            await asyncio.sleep(turn_delay / pieces)
+            delta = {"tool_calls": [{"index": index, **call}]}
+            yield f"data: {json.dumps(chunk(completion_id, model, delta))}\n\n"
+        finish_reason = "tool_calls" if tool_calls else "stop"
+        yield f"data: {json.dumps(chunk(completion_id, model, {}, finish_reason))}\n\n"
+        if usage_data is not None:
+            yield f"data: {json.dumps(chunk(completion_id, model, None, usage=usage_data))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model", "gpt-4o-mini")
+        message_content, tool_calls, turn_delay = reply(body)
+        usage_data = usage(body, message_content, tool_calls)
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            return StreamingResponse(
+                stream_words(completion_id, model, message_content, tool_calls, turn_delay, usage_data if include_usage else None),
+                media_type="text/event-stream",
+            )
+        await asyncio.sleep(turn_delay)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": message_content, "refusal": None, "tool_calls": tool_calls or None},
+                    "finish_reason": "tool_calls" if tool_calls else "stop",
+                    "logprobs": None,
+                }
+            ],
+            "usage": usage_data,
+        }
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app, port):
+    """Start `app` with uvicorn on a daemon thread and wait until it accepts connections."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--transcripts", help="JSON file with recorded tool-calling transcripts")
+    args = parser.parse_args()
+    transcripts = load_transcripts(args.transcripts) if args.transcripts else None
+    app = create_fake_openai_app(delay=args.delay, transcripts=transcripts)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,516 @@
+import os
+import re
+import copy
+import json
+import math
+
+import numpy as np
+import pandas as pd
+
+#Most data points sent with one chart, larger results are downsampled
+CHART_MAX_POINTS = int(os.environ.get("CHART_MAX_POINTS", "5000"))
+
+#Vega-Lite aggregate -> pandas aggregation
+AGGREGATES = {
+    "count": "size",
+    "valid": "count",
+    "sum": "sum",
+    "mean": "mean",
+    "average": "mean",
+    "median": "median",
+    "min": "min",
+    "max": "max",
+    "distinct": "nunique",
+    "stdev": "std",
+    "variance": "var",
+    "q1": lambda s: s.quantile(0.25),
+    "q3": lambda s: s.quantile(0.75),
+}
+
+#Vega-Lite timeUnit -> pandas period used to truncate timestamps
+TIME_UNITS = {
+    "year": "Y",
+    "yearquarter": "Q",
+    "yearmonth": "M",
+    "yearweek": "W",
+    "yearmonthdate": "D",
+    "yearmonthdatehours": "h",
+}
+
+LINE_MARKS = {"line", "area", "trail"}
+#Marks and transforms that summarize rows, so they need all of them
+AGGREGATE_MARKS = {"boxplot", "errorbar", "errorband"}
+AGGREGATING_TRANSFORMS = {
+    "aggregate", "joinaggregate", "window", "density", "quantile",
+    "regression", "loess", "pivot", "stack", "impute", "extent",
+}
+COMPOSITIONS = ("layer", "concat", "hconcat", "vconcat")
+_DATUM_FIELD = re.compile(r"""datum\.(\w+)|datum\[['"](.+?)['"]\]""")
+_COMPARISON = re.compile(r"""^\s*datum(?:\.(\w+)|\[['"](.+?)['"]\])\s*(===|!==|==|!=|>=|<=|>|<)\s*(.+?)\s*$""")
+_OPERATORS = {
+    "==": "eq", "===": "eq", "!=": "ne", "!==": "ne",
+    ">": "gt", ">=": "ge", "<": "lt", "<=": "le",
+}
+
+
+class ChartDataError(ValueError):
+    pass
+
+
+def _mark_type(spec):
+    mark = spec.get("mark")
+    return mark.get("type") if isinstance(mark, dict) else mark
+
+
+def _referenced_fields(node, fields):
+    """Collect every field name a spec refers to, in encodings, transforms and expressions."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ("field", "groupby", "fields") or key == "as":
+                for name in value if isinstance(value, list) else [value]:
+                    if isinstance(name, str):
+                        fields.add(name)
+            elif isinstance(value, str) and "datum" in value:
+                for match in _DATUM_FIELD.finditer(value):
+                    fields.add(match.group(1) or match.group(2))
+            else:
+                _referenced_fields(value, fields)
+    elif isinstance(node, list):
+        for item in node:
+            _referenced_fields(item, fields)
+    return fields
+
+
+def chart_fields(spec) -> set:
+    """Names of the fields a spec (or any of its views) uses, the columns it needs from the dataset."""
+    return _referenced_fields({key: value for key, value in spec.items() if key != "data"}, set())
+
+
+def _literal(text):
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "'\"":
+        return text[1:-1]
+    return json.loads(text)
+
+
+def _filter_mask(df, predicate):
+    """
+    Boolean mask for a Vega-Lite filter, or None if it isn't one of the simple forms:
+    field predicates (equal, oneOf, range, lt, lte, gt, gte) or `datum.field <op> literal`
+    comparisons joined with &&.
+    """
+    if isinstance(predicate, dict):
+        field = predicate.get("field")
+        if field not in df.columns or "timeUnit" in predicate:
+            return None
+        column = df[field]
+        if "equal" in predicate:
+            return column == predicate["equal"]
+        if "oneOf" in predicate:
+            return column.isin(predicate["oneOf"])
+        if "range" in predicate:
+            low, high = predicate["range"]
+            mask = pd.Series(True, index=df.index)
+            if low is not None:
+                mask &= column >= low
+            if high is not None:
+                mask &= column <= high
+            return mask
+        for key, method in (("lt", "lt"), ("lte", "le"), ("gt", "gt"), ("gte", "ge")):
+            if key in predicate:
+                return getattr(column, method)(predicate[key])
+        return None
+    if isinstance(predicate, str):
+        mask = pd.Series(True, index=df.index)
+        for clause in predicate.split("&&"):
+            match = _COMPARISON.match(clause.strip().strip("()"))
+            if match is None:
+                return None
+            field = match.group(1) or match.group(2)
+            if field not in df.columns:
+                return None
+            try:
+                value = _literal(match.group(4))
+            except ValueError:
+                return None
+            mask &= getattr(df[field], _OPERATORS[match.group(3)])(value)
+        return mask
+    return None
+
+
+def _apply_filters(spec, df):
+    """Apply the spec's filter transforms with pandas. Returns None if it has other transforms."""
+    for transform in spec.get("transform", []):
+        if set(transform) != {"filter"}:
+            return None
+        try:
+            mask = _filter_mask(df, transform["filter"])
+        except TypeError:
+            #comparing values of incompatible types
+            return None
+        if mask is None:
+            return None
+        df = df[mask.fillna(False).astype(bool)]
+    return df
+
+
+def _records(df):
+    #to_json handles NaN -> null and timestamps -> ISO strings in one vectorized pass
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+
+def _nice_step(span, maxbins):
+    if span <= 0 or not math.isfinite(span):
+        return 1.0
+    raw = span / maxbins
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for factor in (1, 2, 5, 10):
+        if raw <= factor * magnitude:
+            return factor * magnitude
+    return 10 * magnitude
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    Returns the indices of `threshold` points that keep the visual shape of the series.
+    `x` must be sorted.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    sampled = np.empty(threshold, dtype=np.int64)
+    sampled[0] = a = 0
+    for i in range(threshold - 2):
+        avg_start = int(math.floor((i + 1) * every)) + 1
+        avg_end = min(int(math.floor((i + 2) * every)) + 1, n)
+        avg_x = x[avg_start:avg_end].mean()
+        avg_y = y[avg_start:avg_end].mean()
+        range_start = int(math.floor(i * every)) + 1
+        range_end = int(math.floor((i + 1) * every)) + 1
+        area = np.abs(
+            (x[a] - avg_x) * (y[range_start:range_end] - y[a])
+            - (x[a] - x[range_start:range_end]) * (avg_y - y[a])
+        )
+        a = range_start + int(np.argmax(area))
+        sampled[i + 1] = a
+    sampled[-1] = n - 1
+    return sampled
+
+
+def _downsample_series(df, encoding, max_points):
+    """LTTB on each series of a line chart, series being the color/detail groups."""
+    x_field = encoding["x"]["field"]
+    y_field = encoding["y"]["field"]
+    series_fields = [
+        encoding[channel]["field"] for channel in ("color", "detail", "strokeDash")
+        if isinstance(encoding.get(channel), dict) and "field" in encoding[channel]
+    ]
+    df = df.dropna(subset=[x_field, y_field]).sort_values(x_field, kind="stable")
+    groups = [df] if not series_fields else [group for _, group in df.groupby(series_fields, sort=False)]
+    if len(groups) * 3 > max_points:
+        #Too many series to keep a useful shape for each
+        return None
+    per_series = max_points // len(groups)
+    pieces = []
+    for group in groups:
+        x = group[x_field]
+        x = x.astype("int64").to_numpy(dtype=float) if pd.api.types.is_datetime64_any_dtype(x) else x.to_numpy(dtype=float)
+        y = group[y_field].to_numpy(dtype=float)
+        pieces.append(group.iloc[lttb_indices(x, y, per_series)])
+    return pd.concat(pieces)
+
+
+def _raw_values(spec, df, fields, max_points):
+    """Project the referenced columns and downsample to at most `max_points` rows."""
+    columns = [column for column in df.columns if column in fields] or list(df.columns)
+    projected = df[columns]
+    if len(projected) <= max_points:
+        return projected, False
+
+    encoding = spec.get("encoding", {})
+    x, y = encoding.get("x"), encoding.get("y")
+    if (
+        _mark_type(spec) in LINE_MARKS
+        and isinstance(x, dict) and isinstance(y, dict)
+        and x.get("field") in projected and y.get("field") in projected
+        and x.get("type") in ("quantitative", "temporal") and y.get("type") == "quantitative"
+        and "aggregate" not in y and "bin" not in x
+        and not spec.get("transform")
+    ):
+        if x.get("type") == "temporal" and not pd.api.types.is_datetime64_any_dtype(projected[x["field"]]):
+            projected = projected.assign(**{x["field"]: pd.to_datetime(projected[x["field"]], errors="coerce")})
+        sampled = _downsample_series(projected, encoding, max_points)
+        if sampled is not None:
+            return sampled, True
+
+    #Evenly spaced rows keep the overall distribution and are deterministic
+    positions = np.linspace(0, len(projected) - 1, max_points).astype(np.int64)
+    return projected.iloc[positions], True
+
+
+def _rewrite_definition(channel, definition, encoding, df, work, keys, aggregations, sorts):
+    """
+    Rewrite one encoding definition to plot a precomputed column, adding the group keys,
+    aggregations and sort columns it needs. Returns {channel: definition} (bins add
+    `channel`2) or None when it uses something this doesn't handle.
+    """
+    if definition is None:
+        return {channel: definition}
+    if not isinstance(definition, dict):
+        return None
+    definition = dict(definition)
+    field = definition.get("field")
+    aggregate = definition.pop("aggregate", None)
+    bin_spec = definition.get("bin")
+    time_unit = definition.get("timeUnit")
+
+    sort = definition.get("sort")
+    sort_field = isinstance(sort, dict) and "field" in sort
+
+    if aggregate is not None:
+        if (
+            not isinstance(aggregate, str) or aggregate not in AGGREGATES
+            or (field is None and aggregate != "count") or bin_spec or time_unit or sort_field
+        ):
+            return None
+        name = "count" if field is None or aggregate == "count" else f"{aggregate}_{field}"
+        aggregations.append((name, field, aggregate))
+        title = "Count of Records" if name == "count" else f"{aggregate.capitalize()} of {field}"
+        definition.setdefault("title", title)
+        definition["field"] = name
+        definition.setdefault("type", "quantitative")
+        return {channel: definition}
+
+    if field is None:
+        return {channel: definition}
+
+    if bin_spec and not (isinstance(bin_spec, dict) and bin_spec.get("binned")):
+        if channel not in ("x", "y") or f"{channel}2" in encoding or sort_field:
+            return None
+        values = pd.to_numeric(df[field], errors="coerce")
+        maxbins = bin_spec.get("maxbins", 10) if isinstance(bin_spec, dict) else 10
+        step = bin_spec.get("step") if isinstance(bin_spec, dict) else None
+        step = step or _nice_step(values.max() - values.min(), maxbins)
+        start, end = f"bin_start_{field}", f"bin_end_{field}"
+        work[start] = np.floor(values / step) * step
+        work[end] = work[start] + step
+        keys += [start, end]
+        definition.pop("bin")
+        definition.update({"field": start, "bin": {"binned": True, "step": step}, "type": "quantitative"})
+        definition.setdefault("title", f"{field} (binned)")
+        return {channel: definition, f"{channel}2": {"field": end}}
+
+    name = field
+    if time_unit:
+        unit = time_unit if isinstance(time_unit, str) else time_unit.get("unit")
+        period = TIME_UNITS.get(unit)
+        if period is None:
+            return None
+        #Its own column, so the same field can also be used without the time unit
+        name = f"{unit}_{field}"
+        work[name] = pd.to_datetime(df[field], errors="coerce").dt.to_period(period).dt.start_time
+        definition.pop("timeUnit")
+        definition["field"] = name
+        definition.setdefault("title", f"{field} ({unit})")
+    else:
+        work[field] = df[field]
+    if name not in keys:
+        keys.append(name)
+
+    if sort_field:
+        #The filled values don't have the sort's raw field, sort by its aggregate per value of this one
+        op = sort.get("op")
+        if op == "count":
+            source = None
+        elif isinstance(op, str) and op in AGGREGATES and sort["field"] in df.columns:
+            source = sort["field"]
+        else:
+            return None
+        sort_name = f"count_by_{name}" if source is None else f"{op}_{source}_by_{name}"
+        sorts.append((name, sort_name, source, op))
+        #Constant within each value of the field, so any op but count gives the precomputed aggregate
+        definition["sort"] = {**sort, "field": sort_name, "op": "min"}
+    return {channel: definition}
+
+
+def _aggregate_values(spec, df, max_points):
+    """
+    Compute the encoding's aggregates, bins and time units with pandas, and rewrite
+    the encoding to plot the precomputed columns. List channels (tooltip arrays) are
+    rewritten entry by entry. Returns None when the spec uses something this doesn't
+    handle.
+    """
+    encoding = spec["encoding"]
+    work = {}
+    keys = []
+    aggregations = []
+    sorts = []
+    new_encoding = {}
+
+    for channel, definition in encoding.items():
+        if isinstance(definition, list):
+            entries = [_rewrite_definition(channel, entry, encoding, df, work, keys, aggregations, sorts) for entry in definition]
+            if any(entry is None for entry in entries):
+                return None
+            new_encoding[channel] = [entry[channel] for entry in entries]
+            continue
+        rewritten = _rewrite_definition(channel, definition, encoding, df, work, keys, aggregations, sorts)
+        if rewritten is None:
+            return None
+        new_encoding.update(rewritten)
+
+    if not any(
+        isinstance(definition, dict) and "aggregate" in definition
+        for value in encoding.values()
+        for definition in (value if isinstance(value, list) else [value])
+    ):
+        return None
+
+    for field in [field for _, field, _ in aggregations] + [source for _, _, source, _ in sorts]:
+        if field is not None and field not in work:
+            work[field] = df[field]
+    frame = pd.DataFrame(work, index=df.index)
+
+    if keys:
+        grouped = frame.groupby(keys, dropna=False, sort=True, observed=True)
+        columns = {}
+        for name, field, aggregate in aggregations:
+            columns[name] = grouped.size() if name == "count" else grouped[field].agg(AGGREGATES[aggregate])
+        result = pd.DataFrame(columns).reset_index()
+    else:
+        row = {}
+        for name, field, aggregate in aggregations:
+            row[name] = len(frame) if name == "count" else frame[field].agg(AGGREGATES[aggregate])
+        result = pd.DataFrame([row])
+
+    #Grouped by the sorted field alone, the other keys split its rows further
+    for key, sort_name, source, op in sorts:
+        by_key = frame.groupby(key, dropna=False, observed=True)
+        values = by_key.size() if source is None else by_key[source].agg(AGGREGATES[op])
+        result[sort_name] = result[key].map(values)
+
+    downsampled = len(result) > max_points
+    if downsampled:
+        result = result.iloc[:max_points]
+    return result, new_encoding, downsampled
+
+
+def _combines_rows(spec):
+    """Whether the view summarizes rows (aggregates, aggregating transforms or marks), so a sample would change it."""
+    definitions = [
+        definition
+        for value in (spec.get("encoding") or {}).values()
+        for definition in (value if isinstance(value, list) else [value])
+    ]
+    return (
+        _mark_type(spec) in AGGREGATE_MARKS
+        or any(isinstance(definition, dict) and "aggregate" in definition for definition in definitions)
+        or any(
+            isinstance(transform, dict) and any(key in transform for key in AGGREGATING_TRANSFORMS)
+            for transform in spec.get("transform", [])
+        )
+    )
+
+
+def _fill_view(spec, df, max_points):
+    """Set data.values of a single-view spec in place. Returns (points, downsampled)."""
+    fields = _referenced_fields({key: value for key, value in spec.items() if key != "data"}, set())
+    #With transforms the encoding may use calculated fields, so only check plain specs
+    missing = [field for field in _referenced_fields(spec.get("encoding", {}), set()) if field not in df.columns]
+    if missing and not spec.get("transform"):
+        raise ChartDataError(f"Unknown columns in chart: {', '.join(sorted(missing))}")
+
+    aggregated = None
+    filtered = _apply_filters(spec, df)
+    if filtered is not None and isinstance(spec.get("encoding"), dict):
+        aggregated = _aggregate_values(spec, filtered, max_points)
+    if aggregated is not None:
+        #The filters are already applied to the values
+        spec.pop("transform", None)
+    elif filtered is not None and spec.get("transform"):
+        spec.pop("transform")
+        df = filtered
+
+    if aggregated is not None:
+        values, spec["encoding"], downsampled = aggregated
+    elif _combines_rows(spec) and len(df) > max_points:
+        #Summaries of sampled rows would be wrong, and the full rows are too many to send
+        raise ChartDataError(f"Can't compute this chart's summary on the server for {len(df):,} rows")
+    else:
+        values, downsampled = _raw_values(spec, df, fields, max_points)
+
+    records = _records(values)
+    spec["data"] = {"values": records}
+    return len(records), downsampled
+
+
+def _inherit_transforms(view, transforms):
+    #A composition's transforms run before those of its views
+    if transforms:
+        view["transform"] = transforms + view.get("transform", [])
+
+
+def _fill(spec, df, max_points):
+    """Fill a single view or every view of a layer, concat or facet in place. Returns (points, downsampled)."""
+    if _mark_type(spec):
+        return _fill_view(spec, df, max_points)
+
+    if "facet" in spec and "spec" in spec:
+        inner = spec["spec"]
+        if not isinstance(inner, dict) or not _mark_type(inner):
+            raise ChartDataError("Only facets of a single view are supported")
+        facet = spec["facet"]
+        channels = {key: facet[key] for key in ("row", "column") if key in facet} or {"facet": facet}
+        #Facet fields are group keys of the inner view, then go back to the facet definition
+        inner["encoding"] = {**inner.get("encoding", {}), **channels}
+        _inherit_transforms(inner, spec.pop("transform", []))
+        points, downsampled = _fill_view(inner, df, max_points)
+        rewritten = {key: inner["encoding"].pop(key) for key in channels}
+        spec["facet"] = rewritten.get("facet") or {**facet, **rewritten}
+        spec["data"] = inner.pop("data")
+        return points, downsampled
+
+    views = [key for key in COMPOSITIONS if key in spec]
+    if not views:
+        raise ChartDataError("Unsupported chart composition")
+    shared = spec.pop("encoding", {}) if "layer" in spec else {}
+    transforms = spec.pop("transform", [])
+    spec.pop("data", None)
+    points, downsampled = 0, False
+    for view in spec[views[0]]:
+        if not isinstance(view, dict):
+            raise ChartDataError("Unsupported chart composition")
+        if "values" in (view.get("data") or {}):
+            #Views with their own inline data, like reference lines, keep it
+            continue
+        if shared:
+            view["encoding"] = {**shared, **view.get("encoding", {})}
+        _inherit_transforms(view, transforms)
+        view_points, view_downsampled = _fill(view, df, max_points)
+        points += view_points
+        downsampled = downsampled or view_downsampled
+    return points, downsampled
+
+
+def fill_chart_data(spec: dict, df: pd.DataFrame, max_points=CHART_MAX_POINTS) -> dict:
+    """
+    Return a copy of a Vega-Lite spec whose data.values are computed from the full DataFrame.
+    Aggregates, bins and time units are computed with pandas so only the aggregated points
+    are sent; views without aggregates get the referenced columns of the raw rows,
+    downsampled to `max_points` (LTTB for line charts). Every view of a layer, concat or
+    facet is filled the same way. Raises ChartDataError for charts that can't be filled
+    without changing what they show.
+    """
+    if not spec or not (_mark_type(spec) or any(key in spec for key in (*COMPOSITIONS, "facet", "repeat"))):
+        return spec
+    spec = copy.deepcopy(spec)
+    points, downsampled = _fill(spec, df, max_points)
+    spec["usermeta"] = {
+        **(spec.get("usermeta") or {}),
+        "dataSource": "server",
+        "rows": int(len(df)),
+        "points": points,
+        "downsampled": bool(downsampled),
+    }
+    return spec
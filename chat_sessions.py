@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+
+#Sessions not used for this long are dropped
+SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_SECONDS", "1800"))
+SESSION_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", "1000"))
+#Estimated token budget of a session's history, older turns are evicted past it
+SESSION_MAX_HISTORY_TOKENS = int(os.environ.get("SESSION_MAX_HISTORY_TOKENS", "8000"))
+#Tool outputs of this many most recent turns are kept in full, older ones are truncated
+SESSION_FULL_TURNS = int(os.environ.get("SESSION_FULL_TURNS", "1"))
+SESSION_TOOL_OUTPUT_CHARS = int(os.environ.get("SESSION_TOOL_OUTPUT_CHARS", "300"))
+
+
+def estimate_tokens(messages) -> int:
+    """Rough token count, about four characters per token."""
+    return len(json.dumps(messages, default=str)) // 4
+
+
+def compact_tool_output(message, max_chars=SESSION_TOOL_OUTPUT_CHARS):
+    content = message.get("content") or ""
+    if message.get("role") != "tool" or len(content) <= max_chars:
+        return message
+    return {**message, "content": f"{content[:max_chars]} ... [older tool output truncated, {len(content)} chars]"}
+
+
+class ChatSession:
+    """
+    History of one conversation with the agent.
+
+    `prefix` (system prompt and dataset summary) is never changed, so every request
+    of the session starts with the same bytes and the provider's prompt cache can
+    reuse it. Only the turns after it are compacted and evicted.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.turns = []
+        self.lock = asyncio.Lock()
+        self.last_used = time.time()
+
+    def messages(self):
+        """A new list with the whole conversation, for the agent to extend with the next turn."""
+        return self.prefix + [message for turn in self.turns for message in turn]
+
+    def add_turn(self, messages, max_tokens=SESSION_MAX_HISTORY_TOKENS, full_turns=SESSION_FULL_TURNS):
+        """Append the messages of a finished turn, then compact and evict older turns to fit `max_tokens`."""
+        self.turns.append(list(messages))
+        for i in range(len(self.turns) - full_turns):
+            self.turns[i] = [compact_tool_output(message) for message in self.turns[i]]
+        budget = max_tokens - estimate_tokens(self.prefix)
+        #Whole turns go, so tool results are never separated from the call that asked for them
+        while len(self.turns) > 1 and estimate_tokens(self.turns) > budget:
+            self.turns.pop(0)
+
+    def history_tokens(self):
+        return estimate_tokens(self.turns)
+
+
+class SessionStore:
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_sessions=SESSION_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+
+    def get(self, session_id, prefix):
+        """
+        The session for `session_id`. A new one is started when there is none, it has
+        expired, or it was about different data (another prefix).
+        """
+        now = time.time()
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest.last_used + self.ttl >= now:
+                break
+            del self._sessions[oldest_id]
+
+        session = self._sessions.get(session_id)
+        if session is None or session.prefix != prefix:
+            session = self._sessions[session_id] = ChatSession(prefix)
+        session.last_used = now
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "history_tokens": sum(session.history_tokens() for session in self._sessions.values()),
+        }
@@ -13,6 +13,8 @@ function App() {
   //const [response, setResponse] = useState([]);
   const [chatHistory, setChatHistory] = useState([]);
   const [fileData, setFileData] = useState(null);
+  const [datasetId, setDatasetId] = useState(null); // id of the CSV stored on the server
+  const [sessionId, setSessionId] = useState(() => crypto.randomUUID()); // follow-up questions share the server-side history
   const [fileError, setFileError] = useState("");
   const [dragging, setDragging] = useState(false);
   const [showTable, setShowTable] = useState(false); // table visibility
@@ -37,9 +39,28 @@ function App() {
         setShowTable(true);
       };
       reader.readAsText(file);
+
+      //upload the file once so queries can refer to it by id
+      setDatasetId(null);
+      setSessionId(crypto.randomUUID()); // new data starts a new conversation
+      const formData = new FormData();
+      formData.append('file', file);
+      fetch(`${url}upload`, {
+        method: 'POST',
+        body: formData,
+        mode: 'cors',
+      }).then(response => {
+        if (!response.ok) {
+          throw new Error(`Server error: ${response.status}`);
+        }
+        return response.json();
+      })
+        .then(data => setDatasetId(data.dataset_id))
+        .catch(error => console.log("Upload failed, falling back to sample data:", error));
     } else {
       setFileError("Please upload a valid CSV file.");
       setFileData(null); //clear previous data
+      setDatasetId(null);
       setShowTable(false); // Hide table if upload fails
     }
   };
@@ -100,43 +121,95 @@ function App() {
     const payload = {
       prompt: message,
       //columns_info: formattedColumnsInfo, // Corrected structure
-      sample_data: fileData ? JSON.stringify(fileData.slice(0, 10)) : ""
+      dataset_id: datasetId,
+      session_id: sessionId,
+      //only needed when the server doesn't have the file
+      sample_data: fileData && !datasetId ? JSON.stringify(fileData.slice(0, 10)) : ""
     };
 
-    fetch(`${url}query`, {
+    // replace the placeholder bot message with the latest streamed state
+    function updateBotMessage(fields) {
+      setChatHistory(prevHistory => {
+        const history = [...prevHistory];
+        history[history.length - 1] = { ...history[history.length - 1], ...fields };
+        return history;
+      });
+    }
+
+    // fill the chart with the full uploaded data, null if there is no usable chart
+    function buildChart(vegaSpec) {
+      // charts for uploaded datasets already carry the full (aggregated) data
+      if (vegaSpec && vegaSpec.usermeta && vegaSpec.usermeta.dataSource === "server") {
+        return vegaSpec;
+      }
+      try {
+        const cols = Object.keys(vegaSpec.data.values[0])
+        const full_data = extractRelData(fileData, cols)
+        const chart_data = { ...vegaSpec, data: { ...vegaSpec.data, values: full_data } };
+        return chart_data;
+      }
+      catch(error) {
+        return null;
+      }
+    }
+
+    function handleEvent(event, data) {
+      if (event === "token") {
+        streamedText += data.text;
+        updateBotMessage({ text: streamedText, loading: false });
+      } else if (event === "chart") {
+        updateBotMessage({ vegaSpec: buildChart(data.vegaSpec), loading: false });
+      } else if (event === "done") {
+        console.log("Data received:", data); // Log the received data
+        setLoading(false);
+        updateBotMessage({ text: data.response, vegaSpec: buildChart(data.vegaSpec), loading: false });
+      }
+    }
+
+    let streamedText = "";
+    fetch(`${url}query/stream`, {
       method: 'POST',
       body: JSON.stringify(payload),
       mode: 'cors',
       headers: {
         'Content-Type': 'application/json',
       }
-    }).then(response => {
+    }).then(async response => {
       if (!response.ok) {
         throw new Error(`Server error: ${response.status}`);
       }
-      return response.json();
+      // read Server-Sent Events as they arrive
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+          break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        const blocks = buffer.split("\n\n");
+        buffer = blocks.pop();
+        blocks.forEach(block => {
+          let event = "message";
+          let data = "";
+          block.split("\n").forEach(line => {
+            if (line.startsWith("event: ")) {
+              event = line.slice(7);
+            } else if (line.startsWith("data: ")) {
+              data += line.slice(6);
+            }
+          });
+          if (data) {
+            handleEvent(event, JSON.parse(data));
+          }
+        });
+      }
     })
-      .then(data => {
+      .catch(error => {
+        console.log("Query failed:", error);
         setLoading(false);
-        
-        try {
-          console.log("Data received:", data); // Log the received data
-          const cols = Object.keys(data.vegaSpec.data.values[0])
-          const full_data = extractRelData(fileData, cols)
-          const chart_data = data.vegaSpec
-          chart_data.data.values = full_data;
-
-          const botMessage = {
-            text: data.response,
-            sender: "bot",
-            vegaSpec: chart_data
-          };
-          setChatHistory(prevHistory => [...prevHistory, botMessage]);
-        }
-        catch(error) {
-          const botMessage = { sender: "bot", text: data.response, vegaSpec: null };
-          setChatHistory(prevHistory => [...prevHistory, botMessage]);
-        }
+        updateBotMessage({ text: "An error occurred. Please try again", vegaSpec: null, loading: false });
       });
   }
 
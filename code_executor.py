@@ -0,0 +1,236 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from io import StringIO
+from collections import OrderedDict
+from contextlib import redirect_stdout, redirect_stderr
+
+#Number of pre-started worker processes that run generated code
+CODE_WORKERS = int(os.environ.get("CODE_WORKERS", "2"))
+#Wall-clock limit for one execution, the worker is killed and replaced when it is exceeded
+CODE_TIMEOUT_SECONDS = float(os.environ.get("CODE_TIMEOUT_SECONDS", "10"))
+#Address space limit for each worker process
+CODE_WORKER_MEMORY_MB = int(os.environ.get("CODE_WORKER_MEMORY_MB", "2048"))
+#DataFrames each worker keeps loaded between executions
+CODE_WORKER_CACHED_FRAMES = int(os.environ.get("CODE_WORKER_CACHED_FRAMES", "2"))
+#Printed output kept from one execution, the rest is cut off before it leaves the worker
+CODE_OUTPUT_MAX_CHARS = int(os.environ.get("CODE_OUTPUT_MAX_CHARS", "10000"))
+
+
+class CodeExecutionTimeout(Exception):
+    pass
+
+
+def _limit_memory(memory_limit_mb):
+    try:
+        import resource
+    except ImportError:
+        #resource is not available on Windows
+        return
+    limit = memory_limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _load_frame(pd, path):
+    if path.endswith(".arrow"):
+        import pyarrow.feather as feather
+        return feather.read_feather(path, memory_map=True)
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+class _CappedOutput(StringIO):
+    """Output capture that keeps the first `max_chars` characters and only counts the rest."""
+
+    def __init__(self, max_chars):
+        super().__init__()
+        self.max_chars = max_chars
+        self.kept = 0
+        self.total = 0
+
+    def write(self, text):
+        self.total += len(text)
+        if self.kept < self.max_chars:
+            piece = text[: self.max_chars - self.kept]
+            self.kept += len(piece)
+            super().write(piece)
+        return len(text)
+
+    def getvalue(self):
+        text = super().getvalue()
+        if self.total > self.kept:
+            text += f"... [truncated, {self.total} chars]"
+        return text
+
+
+def _worker_main(conn, memory_limit_mb, cached_frames, max_output_chars):
+    """
+    Loop run inside each worker process.
+    pandas is imported once when the worker starts, and loaded DataFrames are kept
+    between requests so repeated queries on the same dataset skip the parse.
+    """
+    import json
+    import pandas as pd
+
+    _limit_memory(memory_limit_mb)
+    frames = OrderedDict()
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        code, dataset = request
+
+        output = _CappedOutput(max_output_chars)
+        try:
+            namespace = {"pd": pd, "json": json}
+            if dataset is not None:
+                key, path = dataset
+                if key not in frames:
+                    frames[key] = _load_frame(pd, path)
+                    while len(frames) > cached_frames:
+                        frames.popitem(last=False)
+                frames.move_to_end(key)
+                #Copy so one execution cannot change the data seen by the next
+                namespace["df"] = frames[key].copy(deep=False)
+            with redirect_stdout(output), redirect_stderr(output):
+                exec(code, namespace)
+            result = output.getvalue()
+        except MemoryError as e:
+            frames.clear()
+            result = repr(e)
+        except Exception as e:
+            result = repr(e)
+        conn.send((result, list(frames)))
+
+
+class _Worker:
+    def __init__(self, context, memory_limit_mb, cached_frames, max_output_chars):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, memory_limit_mb, cached_frames, max_output_chars),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.loaded = []
+
+    def execute(self, code, dataset, timeout):
+        self.conn.send((code, dataset))
+        if not self.conn.poll(timeout):
+            raise CodeExecutionTimeout(f"Code execution exceeded {timeout:.1f} seconds")
+        result, self.loaded = self.conn.recv()
+        return result
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=1)
+        self.kill()
+
+
+class CodeWorkerPool:
+    """
+    Fixed-size pool of worker processes for running generated pandas code.
+    Each execution gets its own output capture, a timeout, and a memory limit.
+    A worker that times out or dies is replaced without affecting the others.
+    """
+
+    def __init__(self, size=CODE_WORKERS, timeout=CODE_TIMEOUT_SECONDS,
+                 memory_limit_mb=CODE_WORKER_MEMORY_MB, cached_frames=CODE_WORKER_CACHED_FRAMES,
+                 max_output_chars=CODE_OUTPUT_MAX_CHARS):
+        self.size = size
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.cached_frames = cached_frames
+        self.max_output_chars = max_output_chars
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._condition = threading.Condition()
+        self._started = False
+
+    def _new_worker(self):
+        return _Worker(self._context, self.memory_limit_mb, self.cached_frames, self.max_output_chars)
+
+    def start(self):
+        with self._condition:
+            if self._started:
+                return
+            self._idle = [self._new_worker() for _ in range(self.size)]
+            self._started = True
+
+    def shutdown(self):
+        with self._condition:
+            workers, self._idle = self._idle, []
+            self._started = False
+        for worker in workers:
+            worker.close()
+
+    def _acquire(self, key, timeout):
+        """An idle worker, waiting at most `timeout` seconds for one. Raises CodeExecutionTimeout."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self._idle:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    if not self._idle:
+                        raise CodeExecutionTimeout(f"No code worker became free within {timeout:.1f} seconds")
+            #Prefer a worker that already has this dataset loaded
+            for i, worker in enumerate(self._idle):
+                if key is not None and key in worker.loaded:
+                    return self._idle.pop(i)
+            return self._idle.pop()
+
+    def _release(self, worker):
+        with self._condition:
+            if self._started:
+                self._idle.append(worker)
+                self._condition.notify()
+            else:
+                worker.close()
+
+    def execute(self, code, dataset=None, timeout=None):
+        """
+        Run `code` in a worker and return everything it printed, or repr() of the error.
+        `dataset` is an optional (key, path) pair, the frame is available to the code as `df`.
+        `timeout` covers waiting for a free worker and running the code.
+        """
+        self.start()
+        timeout = self.timeout if timeout is None else timeout
+        start = time.perf_counter()
+        try:
+            worker = self._acquire(dataset[0] if dataset else None, timeout)
+        except CodeExecutionTimeout as e:
+            logging.warning(f"Code execution not started: {e}")
+            return repr(e)
+        try:
+            result = worker.execute(code, dataset, max(0.0, timeout - (time.perf_counter() - start)))
+        except (CodeExecutionTimeout, EOFError, OSError) as e:
+            if isinstance(e, CodeExecutionTimeout):
+                logging.warning(f"Killing code worker after {time.perf_counter() - start:.1f}s: {e}")
+                #Reported against the whole timeout, part of it may have been spent waiting for the worker
+                error = CodeExecutionTimeout(f"Code execution exceeded {timeout:.1f} seconds")
+            else:
+                logging.error(f"Code worker died: {e!r}")
+                error = RuntimeError("Code execution worker crashed, possibly out of memory")
+            worker.kill()
+            worker = self._new_worker()
+            self._release(worker)
+            return repr(error)
+        self._release(worker)
+        return result
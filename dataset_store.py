@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import suppress
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from profiler import profile_dataframe
+
+#Where parsed datasets are kept, one Arrow file per distinct CSV
+DATASET_DIR = os.environ.get(
+    "DATASET_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "datasets"),
+)
+#Upper bound on the memory used by DataFrames held in the in-process cache
+DATASET_CACHE_BYTES = int(os.environ.get("DATASET_CACHE_MB", "512")) * 1024 * 1024
+#Upper bound on the disk used by stored datasets, the least recently used are deleted past it
+DATASET_DISK_BYTES = int(os.environ.get("DATASET_DISK_MB", "10240")) * 1024 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+#Memory-mapped tables kept open, datasets too large for the frame cache are read from them
+_OPEN_TABLES = 8
+_DATASET_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class DatasetNotFound(KeyError):
+    pass
+
+
+def frame_nbytes(df) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class DatasetStore:
+    """
+    Content-addressed store of uploaded CSV files.
+    Each CSV is parsed once with pandas and written as an uncompressed Arrow file,
+    which is memory-mapped when read back. Loaded DataFrames are kept in an LRU
+    bounded by their in-memory size; larger datasets stay mapped and only the
+    columns a caller needs are converted. The files are kept in an LRU bounded by
+    their size on disk (a file's mtime is its last use).
+    """
+
+    def __init__(self, directory=DATASET_DIR, max_bytes=DATASET_CACHE_BYTES, max_disk_bytes=DATASET_DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._frames = OrderedDict()
+        self._sizes = {}
+        self._cached_bytes = 0
+        self._profiles = {}
+        self._tables = OrderedDict()
+        self._oversized = set()
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, dataset_id) -> str:
+        if not _DATASET_ID.match(dataset_id or ""):
+            raise DatasetNotFound(dataset_id)
+        path = os.path.join(self.directory, f"{dataset_id}.arrow")
+        if not os.path.exists(path):
+            raise DatasetNotFound(dataset_id)
+        #Marks it as recently used for the disk LRU
+        with suppress(OSError):
+            os.utime(path)
+        return path
+
+    def exists(self, dataset_id) -> bool:
+        try:
+            self.path(dataset_id)
+            return True
+        except DatasetNotFound:
+            return False
+
+    def put_csv(self, fileobj) -> str:
+        """
+        Store the CSV read from `fileobj` and return its dataset id.
+        Uploading the same bytes again returns the same id without re-parsing.
+        """
+        digest = hashlib.sha256()
+        fd, csv_path = tempfile.mkstemp(suffix=".csv", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in iter(lambda: fileobj.read(_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    out.write(chunk)
+            dataset_id = digest.hexdigest()[:32]
+            if self.exists(dataset_id):
+                return dataset_id
+
+            df = pd.read_csv(csv_path)
+            arrow_path = os.path.join(self.directory, f"{dataset_id}.arrow")
+            #A unique temporary name, concurrent uploads of the same file each write their own
+            tmp_fd, tmp_arrow_path = tempfile.mkstemp(suffix=".arrow.tmp", dir=self.directory)
+            os.close(tmp_fd)
+            try:
+                feather.write_feather(df, tmp_arrow_path, compression="uncompressed")
+                self._write_profile(dataset_id, df)
+                os.replace(tmp_arrow_path, arrow_path)
+            except BaseException:
+                with suppress(FileNotFoundError):
+                    os.remove(tmp_arrow_path)
+                raise
+            logging.info(f"Stored dataset {dataset_id}: {len(df)} rows, {len(df.columns)} columns")
+            self._remember(dataset_id, df)
+            self._evict_files(keep=dataset_id)
+            return dataset_id
+        finally:
+            os.remove(csv_path)
+
+    def _open_table(self, dataset_id) -> pa.Table:
+        path = self.path(dataset_id)
+        with self._lock:
+            if dataset_id in self._tables:
+                self._tables.move_to_end(dataset_id)
+                return self._tables[dataset_id]
+        #Zero-copy view of the file, only the pages that are touched get read
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        with self._lock:
+            table = self._tables.setdefault(dataset_id, table)
+            while len(self._tables) > _OPEN_TABLES:
+                self._tables.popitem(last=False)
+        return table
+
+    def get(self, dataset_id, columns=None) -> pd.DataFrame:
+        """
+        The dataset as a DataFrame. Datasets too large for the frame cache are converted
+        from the mapped table on every call, so only `columns` of them are (all if None).
+        Cached frames are returned whole, callers must accept extra columns.
+        """
+        #Also for cached frames, so datasets in use stay on disk
+        self.path(dataset_id)
+        with self._lock:
+            if dataset_id in self._frames:
+                self._frames.move_to_end(dataset_id)
+                return self._frames[dataset_id]
+
+        table = self._open_table(dataset_id)
+        if dataset_id in self._oversized or table.nbytes > self.max_bytes:
+            if columns is not None:
+                wanted = set(columns)
+                table = table.select([name for name in table.column_names if name in wanted])
+            return table.to_pandas()
+        df = table.to_pandas()
+        self._remember(dataset_id, df)
+        return df
+
+    def columns(self, dataset_id):
+        return self._open_table(dataset_id).column_names
+
+    def head(self, dataset_id, n=10) -> pd.DataFrame:
+        """First `n` rows, read from the mapped file without loading the whole dataset."""
+        return self._open_table(dataset_id).slice(0, n).to_pandas()
+
+    def info(self, dataset_id):
+        """Row count and (name, dtype) pairs for each column."""
+        table = self._open_table(dataset_id)
+        dtypes = table.slice(0, 0).to_pandas().dtypes
+        return table.num_rows, [(name, str(dtype)) for name, dtype in dtypes.items()]
+
+    def _profile_path(self, dataset_id) -> str:
+        return os.path.join(self.directory, f"{dataset_id}.profile.json")
+
+    def _write_profile(self, dataset_id, df):
+        profile = profile_dataframe(df)
+        fd, tmp_path = tempfile.mkstemp(suffix=".profile.tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(profile, f)
+            os.replace(tmp_path, self._profile_path(dataset_id))
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+        self._profiles[dataset_id] = profile
+        return profile
+
+    def profile(self, dataset_id) -> dict:
+        """Column profile computed when the dataset was stored, see profiler.profile_dataframe."""
+        if dataset_id in self._profiles:
+            return self._profiles[dataset_id]
+        self.path(dataset_id)
+        try:
+            with open(self._profile_path(dataset_id), encoding="utf-8") as f:
+                profile = json.load(f)
+        except FileNotFoundError:
+            return self._write_profile(dataset_id, self.get(dataset_id))
+        self._profiles[dataset_id] = profile
+        return profile
+
+    def _remember(self, dataset_id, df):
+        size = frame_nbytes(df)
+        if size > self.max_bytes:
+            #Too large to cache, callers read the columns they need from the mapped file each time
+            self._oversized.add(dataset_id)
+            return
+        with self._lock:
+            if dataset_id in self._frames:
+                return
+            self._frames[dataset_id] = df
+            self._sizes[dataset_id] = size
+            self._cached_bytes += size
+            while self._cached_bytes > self.max_bytes:
+                evicted, _ = self._frames.popitem(last=False)
+                self._cached_bytes -= self._sizes.pop(evicted)
+
+    def _forget(self, dataset_id):
+        self._profiles.pop(dataset_id, None)
+        self._oversized.discard(dataset_id)
+        with self._lock:
+            self._tables.pop(dataset_id, None)
+            if self._frames.pop(dataset_id, None) is not None:
+                self._cached_bytes -= self._sizes.pop(dataset_id)
+
+    def _evict_files(self, keep):
+        """Delete the least recently used datasets until the directory fits in `max_disk_bytes`."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".arrow") or not _DATASET_ID.match(name[: -len(".arrow")]):
+                continue
+            dataset_id = name[: -len(".arrow")]
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            size = stat.st_size
+            with suppress(OSError):
+                size += os.path.getsize(self._profile_path(dataset_id))
+            entries.append((stat.st_mtime, dataset_id, size))
+
+        total = sum(size for _, _, size in entries)
+        for _, dataset_id, size in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            if dataset_id == keep:
+                continue
+            for path in (os.path.join(self.directory, f"{dataset_id}.arrow"), self._profile_path(dataset_id)):
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+            self._forget(dataset_id)
+            total -= size
+            logging.info(f"Evicted dataset {dataset_id} from disk ({size} bytes)")
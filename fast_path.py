@@ -0,0 +1,268 @@
+import re
+from typing import Optional
+
+import pandas as pd
+
+#Grouped answers with more groups than this are left to the agent
+FAST_PATH_MAX_GROUPS = 50
+#Default number of values for "top" and "most common" questions
+FAST_PATH_TOP_K = 5
+
+AGGREGATES = {
+    "average": "mean",
+    "mean": "mean",
+    "median": "median",
+    "sum": "sum",
+    "total": "sum",
+    "max": "max",
+    "maximum": "max",
+    "highest": "max",
+    "largest": "max",
+    "min": "min",
+    "minimum": "min",
+    "lowest": "min",
+    "smallest": "min",
+    "standard deviation": "std",
+    "std": "std",
+}
+AGGREGATE_WORDS = "|".join(sorted(AGGREGATES, key=len, reverse=True))
+
+#Longer phrases first so "is greater than" isn't read as "is"
+OPERATORS = [
+    ("is greater than or equal to", ">="), ("is less than or equal to", "<="),
+    ("is greater than", ">"), ("greater than", ">"), ("is more than", ">"), ("more than", ">"),
+    ("above", ">"), ("over", ">"),
+    ("is less than", "<"), ("less than", "<"), ("below", "<"), ("under", "<"),
+    ("is not", "!="), ("not equal to", "!="), ("equals", "=="), ("equal to", "=="), ("is", "=="),
+    (">=", ">="), ("<=", "<="), ("!=", "!="), ("==", "=="), (">", ">"), ("<", "<"), ("=", "=="),
+]
+OPERATOR_PATTERN = "|".join(re.escape(phrase) for phrase, _ in OPERATORS)
+OPERATOR_SYMBOLS = dict(OPERATORS)
+
+ROWS = r"(?:rows|records|entries|observations|data points)"
+LEAD_IN = re.compile(
+    r"^(?:(?:please|can you|could you|tell me|find|compute|calculate|get|what is|what's|what are|what were|what was)\s+)+"
+)
+#Questions asking to see the data may want a chart, only the agent can draw one
+VISUAL = re.compile(r"\b(?:show|plot|chart|graph|visuali[sz]e|draw|display|histogram|diagram)")
+#Columns whose numbers are labels, like years and ids, are printed without thousands separators
+LABEL_COLUMN = re.compile(r"(?:^|[_\s])(?:year|yr|id|code|zip)s?$|^(?:year|id)(?:[_\s]|$)", re.IGNORECASE)
+
+COUNT_ROWS = re.compile(rf"^(?:how many|number of|count(?: of| the)?) {ROWS}(?: are there| do we have)?(?: in (?:the )?(?:dataset|data set|data|table|file))?(?: in total)?(?P<filter> (?:where|with|that have|having) .+)?$")
+COUNT_WHERE = re.compile(rf"^how many (?:{ROWS}|\w+) (?:are there )?(?:where|with|that have|having|have|has) (?P<filter>.+)$")
+COUNT_BY = re.compile(
+    rf"^(?:how many (?:{ROWS}|\w+) (?:are there )?|(?:the )?(?:number|count) of (?:{ROWS}|\w+) |count(?: of)? (?:{ROWS} )?)"
+    r"(?:(?:from|for|in|by|per) each|per|by|for every|grouped by) (?:the )?(?P<by>.+)$"
+)
+DISTINCT = re.compile(r"^(?:how many|(?:the )?number of) (?:unique|distinct|different) (?P<column>.+?)(?: are there| values)?$")
+AGGREGATE = re.compile(
+    rf"^(?:the )?(?P<agg>{AGGREGATE_WORDS}) (?:value )?(?:of )?(?:the )?(?P<column>.+?)"
+    #"of cars" in "average mpg of cars with ..." names the rows, not a column
+    r"(?: of (?:all )?(?:the )?\w+(?= (?:by|per|for each|grouped by|across|where|when|with) ))?"
+    r"(?: (?:by|per|for each|grouped by|across) (?:the )?(?P<by>.+?))?"
+    r"(?P<filter> (?:where|when|with) .+)?$"
+)
+TOP_K = re.compile(
+    r"^(?:the )?(?:top|most common|most frequent)(?: (?P<k>\d+))? (?P<column>.+?)"
+    rf"(?: by (?:count|frequency|number of {ROWS}|(?P<agg>{AGGREGATE_WORDS}) (?:of )?(?P<value>.+?)))?$"
+)
+
+
+def normalize_question(question: str) -> str:
+    text = " ".join(question.lower().split()).rstrip("?!. ")
+    return LEAD_IN.sub("", text)
+
+
+def question_columns(question: str, columns) -> list:
+    """Columns a question may refer to: those whose name appears in it, with or without underscores."""
+    text = normalize_question(question)
+    return [
+        column for column in columns
+        if str(column).lower() in text or str(column).lower().replace("_", " ") in text
+    ]
+
+
+def _resolve_column(phrase, df) -> Optional[str]:
+    """Column named by `phrase`, also accepting plurals and spaces for underscores, or None."""
+    phrase = phrase.strip().strip("'\"`").removeprefix("the ").strip()
+    candidates = {phrase, phrase.replace(" ", "_")}
+    for suffix in ("es", "s"):
+        if phrase.endswith(suffix):
+            candidates.add(phrase[: -len(suffix)])
+            candidates.add(phrase[: -len(suffix)].replace(" ", "_"))
+    matches = [column for column in df.columns if str(column).lower() in candidates]
+    return matches[0] if len(matches) == 1 else None
+
+
+def _is_numeric(series) -> bool:
+    return pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+
+
+def _condition(condition, df):
+    """(mask, description) for one condition such as "mpg > 30" or "origin is usa", or None."""
+    match = re.match(rf"^(?P<column>.+?) (?P<op>{OPERATOR_PATTERN}) (?P<value>.+)$", condition)
+    if match is None:
+        return None
+    column = _resolve_column(match["column"], df)
+    if column is None:
+        return None
+    op = OPERATOR_SYMBOLS[match["op"]]
+    raw = match["value"].strip().strip("'\"`")
+    series = df[column]
+    if _is_numeric(series):
+        try:
+            value = float(raw)
+        except ValueError:
+            return None
+    else:
+        if op not in ("==", "!="):
+            return None
+        #Compare text case-insensitively, with the value spelled as in the data
+        values = {str(v).lower(): v for v in series.dropna().unique()}
+        if raw not in values:
+            return None
+        value = values[raw]
+    mask = {
+        "==": series == value, "!=": series != value,
+        ">": series > value, ">=": series >= value,
+        "<": series < value, "<=": series <= value,
+    }[op]
+    return mask, f"{column} {'=' if op == '==' else op} {f'{value:g}' if _is_numeric(series) else value}"
+
+
+def _apply_filter(text, df):
+    """(filtered frame, description), or None when a condition can't be read."""
+    if not text:
+        return df, ""
+    text = re.sub(r"^\s*(?:where|when|with|that have|having)\s+", "", text)
+    mask = None
+    descriptions = []
+    for condition in text.split(" and "):
+        parsed = _condition(condition.strip(), df)
+        if parsed is None:
+            return None
+        mask = parsed[0] if mask is None else mask & parsed[0]
+        descriptions.append(parsed[1])
+    return df[mask], f" where {' and '.join(descriptions)}"
+
+
+def _is_label_column(column) -> bool:
+    name = str(column)
+    return bool(LABEL_COLUMN.search(name)) or name.endswith(("Id", "ID"))
+
+
+def _format_number(value, group=True) -> str:
+    """`value` for an answer, with thousands separators unless `group` is False (years, ids)."""
+    if pd.isna(value):
+        return "not available"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return f"{int(value):,}" if group else str(int(value))
+    return (f"{value:,.4f}" if group else f"{value:.4f}").rstrip("0").rstrip(".")
+
+
+def _format_table(series, key, value, group=True) -> str:
+    lines = [f"| {key} | {value} |", "| --- | --- |"]
+    lines += [f"| {index} | {_format_number(v, group)} |" for index, v in series.items()]
+    return "\n".join(lines)
+
+
+def _count_rows(match, df):
+    filtered = _apply_filter(match["filter"], df)
+    if filtered is None:
+        return None
+    frame, description = filtered
+    return f"There are {len(frame):,} rows{description}."
+
+
+def _count_by(match, df):
+    by = _resolve_column(match["by"], df)
+    if by is None:
+        return None
+    counts = df[by].value_counts(dropna=True)
+    if len(counts) > FAST_PATH_MAX_GROUPS:
+        return None
+    return f"Number of rows for each {by}:\n\n{_format_table(counts, by, 'count')}"
+
+
+def _distinct(match, df):
+    column = _resolve_column(match["column"], df)
+    if column is None:
+        return None
+    return f"There are {df[column].nunique(dropna=True):,} distinct values of {column}."
+
+
+def _aggregate(match, df):
+    column = _resolve_column(match["column"], df)
+    if column is None or not _is_numeric(df[column]):
+        return None
+    filtered = _apply_filter(match["filter"], df)
+    if filtered is None:
+        return None
+    frame, description = filtered
+    func = AGGREGATES[match["agg"]]
+    if match["by"] is None:
+        return f"The {func} of {column}{description} is {_format_number(frame[column].agg(func), not _is_label_column(column))}."
+    by = _resolve_column(match["by"], df)
+    if by is None:
+        return None
+    grouped = frame.groupby(by, observed=True)[column].agg(func)
+    if len(grouped) > FAST_PATH_MAX_GROUPS:
+        return None
+    table = _format_table(grouped, by, f"{func} {column}", not _is_label_column(column))
+    return f"The {func} of {column} by {by}{description}:\n\n{table}"
+
+
+def _top_k(match, df):
+    column = _resolve_column(match["column"], df)
+    if column is None:
+        return None
+    k = int(match["k"]) if match["k"] else (1 if match[0].startswith(("most", "the most")) else FAST_PATH_TOP_K)
+    if match["agg"] is None:
+        #"top 5 horsepower" may mean the largest values rather than the most frequent, leave it to the agent
+        if _is_numeric(df[column]) and match[0].startswith(("top", "the top")) and " by " not in match[0]:
+            return None
+        top = df[column].value_counts(dropna=True).head(k)
+        if k == 1 and len(top):
+            return f"The most common {column} is {top.index[0]} ({top.iloc[0]:,} rows)."
+        return f"The {len(top)} most common values of {column}:\n\n{_format_table(top, column, 'count')}"
+    value = _resolve_column(match["value"], df)
+    if value is None or not _is_numeric(df[value]):
+        return None
+    func = AGGREGATES[match["agg"]]
+    top = df.groupby(column, observed=True)[value].agg(func).nlargest(k)
+    table = _format_table(top, column, f"{func} {value}", not _is_label_column(value))
+    return f"The top {len(top)} values of {column} by {func} {value}:\n\n{table}"
+
+
+#Tried in order; each handler returns None when the question only looks like its pattern
+ROUTES = [
+    (COUNT_ROWS, _count_rows),
+    (COUNT_WHERE, _count_rows),
+    (DISTINCT, _distinct),
+    (COUNT_BY, _count_by),
+    (AGGREGATE, _aggregate),
+    (TOP_K, _top_k),
+]
+
+
+def answer_simple_question(question: str, df: pd.DataFrame) -> Optional[str]:
+    """
+    Answer a simple count, aggregate, filter or top-k question about `df` directly
+    with pandas. Returns None when the question isn't one of those, asks to see
+    the data (which may want a chart) or names anything that isn't a column, so
+    the caller can fall back to the agent.
+    """
+    text = normalize_question(question)
+    if VISUAL.search(text):
+        return None
+    for pattern, handler in ROUTES:
+        match = pattern.match(text)
+        if match is None:
+            continue
+        try:
+            answer = handler(match, df)
+        except (TypeError, ValueError):
+            answer = None
+        if answer is not None:
+            return answer
+    return None
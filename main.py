@@ -1,28 +1,64 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, UploadFile, File
 from fastapi.staticfiles import StaticFiles
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, StreamingResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from openai import OpenAI
+from pydantic import BaseModel, Field
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.types.chat import ChatCompletionMessage
+import httpx
+import asyncio
 import os
-import sys
 import re
+import time
+import atexit
 from dotenv import load_dotenv
 import json 
+import hashlib
 import logging
-from typing import List
-from jsonschema import validate, ValidationError
-import requests
+from typing import List, Optional
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from contextvars import ContextVar, copy_context
 import pandas as pd
-from io import StringIO
 
-#set up logging
-logging.basicConfig(level=logging.INFO) 
-
-#Load environment varaibles from .env file
+#Load environment varaibles from .env file, before the modules below read their settings
 load_dotenv()
 
-app = FastAPI()
+from vega_validation import get_vega_lite_validator, validate_vega_lite_spec
+from code_executor import CodeWorkerPool
+from dataset_store import DatasetStore, DatasetNotFound
+from profiler import format_profile
+from response_cache import create_response_cache, make_cache_key
+from chat_sessions import SessionStore
+from fast_path import answer_simple_question, question_columns
+from resilience import (
+    REJECTED_REQUESTS, BudgetExceeded, CircuitOpen, Overloaded, ClientDisconnected, openai_breaker, openai_call,
+    start_request_budget, check_budget, remaining_time, spend_tokens,
+)
+from chart_data import fill_chart_data, chart_fields, ChartDataError
+from telemetry import (
+    FAST_PATH_QUERIES, RequestTracingMiddleware, span, observe_span, record_token_usage, register_collector,
+    render_metrics, log_payload, setup_logging,
+)
+
+#set up logging, records are written by a background thread
+log_listener = setup_logging(logging.INFO)
+atexit.register(log_listener.stop)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    #Compile the bundled Vega-Lite schema once, before the first request needs it
+    get_vega_lite_validator()
+    #Start the code workers now so the first query doesn't pay for importing pandas
+    code_pool.start()
+    yield
+    await client.close()
+    tool_executor.shutdown(wait=False, cancel_futures=True)
+    code_executor.shutdown(wait=False, cancel_futures=True)
+    code_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 #Configure CORS
 app.add_middleware(
@@ -31,15 +67,80 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+#Plain ASGI middleware, so endpoints can still see the client disconnecting
+app.add_middleware(RequestTracingMiddleware)
+
+#Models used by the agent loop and by the tools
+AGENT_MODEL = "gpt-4o-mini"
+CHART_MODEL = "gpt-3.5-turbo"
+CODE_MODEL = "gpt-4o-mini"
+
+#Connection pool shared by every OpenAI call in this process
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+#Maximum number of /query requests handled at once by this process, extra requests wait for a slot
+MAX_CONCURRENT_QUERIES = int(os.environ.get("MAX_CONCURRENT_QUERIES", "32"))
+#Longest a request waits for a slot before it's turned away with 503
+QUERY_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("QUERY_QUEUE_TIMEOUT_SECONDS", "5"))
+#How often a running /query checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 0.5
+#Threads for blocking tool work (code execution, schema validation)
+TOOL_EXECUTOR_WORKERS = int(os.environ.get("TOOL_EXECUTOR_WORKERS", "4"))
+#Longest a single tool call may run before its result is replaced by a timeout error
+TOOL_TIMEOUT_SECONDS = float(os.environ.get("TOOL_TIMEOUT_SECONDS", "60"))
+#Answer simple count/aggregate/top-k questions on stored datasets with pandas instead of the agent
+FAST_PATH = os.environ.get("FAST_PATH", "1") == "1"
+
 #Load OpenAI API key from environment variable
-client = OpenAI(
+client = AsyncOpenAI(
     #This is the default and can be omitted
     api_key=os.environ.get("OPENAI_API_KEY"),
+    #Retries are done by openai_call, within the request's time budget
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+    ),
 )
 
-VEGA_LITE_SCHEMA_URL = "https://vega.github.io/schema/vega-lite/v5.json"
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_EXECUTOR_WORKERS, thread_name_prefix="tool")
+query_semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+code_pool = CodeWorkerPool()
+#One thread per code worker, so executions waiting for a worker don't hold tool_executor threads
+code_executor = ThreadPoolExecutor(max_workers=code_pool.size, thread_name_prefix="code")
+dataset_store = DatasetStore()
+response_cache = create_response_cache()
+#Conversation history of multi-turn chats, by session_id
+chat_sessions = SessionStore()
+
+#Id of the uploaded dataset the current /query request works on
+current_dataset = ContextVar("current_dataset", default=None)
+
+async def dataset_summary(example_rows=0):
+    """
+    Column profile of the current request's dataset as prompt text, plus a few
+    example rows if asked for. Returns None when the request has no stored dataset.
+    """
+    dataset_id = current_dataset.get()
+    if not dataset_id:
+        return None
+    summary = format_profile(await run_blocking(dataset_store.profile, dataset_id))
+    if example_rows:
+        head = await run_blocking(dataset_store.head, dataset_id, example_rows)
+        summary += f"\nExample rows: {head.to_json(orient='records')}"
+    return summary
+
+async def run_blocking(func, *args, executor=None, **kwargs):
+    """Run a blocking function on the tool executor (or `executor`) so the event loop stays free."""
+    loop = asyncio.get_running_loop()
+    #Carry the request's context variables over to the executor thread
+    context = copy_context()
+    return await loop.run_in_executor(executor or tool_executor, partial(context.run, func, *args, **kwargs))
 
 class ColumnInfo(BaseModel):
     name: str
@@ -47,7 +148,15 @@ class ColumnInfo(BaseModel):
 
 class QueryRequest(BaseModel):
     prompt: str
-    sample_data: str
+    sample_data: str = ""
+    dataset_id: Optional[str] = None
+    #Follow-up questions with the same session_id see the earlier turns of the conversation
+    session_id: Optional[str] = Field(None, max_length=64, pattern=r"^[A-Za-z0-9_-]+$")
+
+class UploadResponse(BaseModel):
+    dataset_id: str
+    rows: int
+    columns: List[ColumnInfo]
 
 class QueryResponse(BaseModel):
     response: str
@@ -66,7 +175,7 @@ generate_chart = {
             "properties": {
                 "data": {
                     "type": "string",
-                    "description": "The data to generate the Vega-Lite JSON specification for.",
+                    "description": "The data to generate the Vega-Lite JSON specification for. For an uploaded dataset only name the relevant columns, do not copy rows.",
                 },
                 "input_prompt": {
                     "type": "string",
@@ -89,7 +198,7 @@ data_analysis_code = {
             "properties": {
                 "data" : {
                     "type" : "string",
-                    "description" : "The data to use in the python code.",
+                    "description" : "The data to use in the python code. For an uploaded dataset only name the relevant columns, do not copy rows.",
                 },
                 "task": {
                     "type": "string",
@@ -124,18 +233,11 @@ execute_panda_dataframe_code = {
 
 tools = [generate_chart, data_analysis_code, execute_panda_dataframe_code]
 
-def validate_vega_lite_spec(spec: dict):
-    try:
-        schema = requests.get(VEGA_LITE_SCHEMA_URL).json()
-        validate(instance=spec, schema=schema)
-        return True
-    except ValidationError as e:
-        logging.error(f"Vega-Lite spec validation error: {str(e)}")
-        return False
-    
-
-def generate_chart(data, input_prompt):
-    print("entered generate_chart")
+async def generate_chart(data, input_prompt):
+    logging.debug("entered generate_chart")
+    #For stored datasets describe the columns instead of using the data the model passed in
+    summary = await dataset_summary(example_rows=3)
+    data = summary or data
     system_prompt = f"""
         You are an AI assistant designed to generate vega-lite specifications. Make sure that the response adheres to this example general format: {{
         "$schema": "https://vega.github.io/schema/vega-lite/v5.json",
@@ -159,6 +261,24 @@ def generate_chart(data, input_prompt):
         If there is an issue generating the visualization, please return an empty vega-lite JSON specification.
         Your response must be a vega-lite JSON specification with one data point, and a description.
         """
+    if summary:
+        #The server computes data.values from the full dataset, so the model only describes the chart
+        system_prompt = f"""
+        You are an AI assistant designed to generate vega-lite specifications. The data values are filled in from the full dataset afterwards, so do not include any data values. Make sure that the response adheres to this example general format: {{
+        "$schema": "https://vega.github.io/schema/vega-lite/v5.json",
+        "data": {{"name": "table"}},
+        "mark": "bar",
+        "encoding": {{
+            "x": {{"field": "origin", "type": "nominal"}},
+            "y": {{"field": "mpg", "aggregate": "mean", "type": "quantitative"}},
+            "color": {{"field": "origin", "type": "nominal"}}
+            }}
+        }}
+        Include the schema, the data name, mark, and encoding fields. Encoding should use the exact column names from the data summary and the correct types.
+        Express summaries with the aggregate, bin and timeUnit properties of the encoding, and filtering with filter transforms.
+        If there is an issue generating the visualization, please return an empty vega-lite JSON specification.
+        Your response must be a vega-lite JSON specification without data values, and a description.
+        """
     
     vega_lite_prompt = f"""
         Generate a JSON object with two fields:
@@ -169,20 +289,23 @@ def generate_chart(data, input_prompt):
     
     # Call the OpenAI API via LangChain
     try:
-        chat_completion = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": vega_lite_prompt}
-            ],
-        )
-        logging.info(f"OpenAI API response: {chat_completion}")
+        with span("llm", CHART_MODEL):
+            chat_completion = await openai_call(
+                client.chat.completions.create,
+                model=CHART_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": vega_lite_prompt}
+                ],
+            )
+        record_usage(CHART_MODEL, chat_completion.usage)
+        log_payload("OpenAI API response", chat_completion)
     except Exception as e:
         logging.error(f"API call failed: {e}")
         raise HTTPException(status_code=500, detail="API call failed.")
 
     ai_response = chat_completion.choices[0].message.content
-    logging.info(f"Received response from generate_chart: {ai_response}")  # Log AI response
+    log_payload("Received response from generate_chart", ai_response)  # Log AI response
     
     try:
         ai_response_json = json.loads(ai_response)
@@ -194,7 +317,18 @@ def generate_chart(data, input_prompt):
     text_response = ai_response_json.get("response", {})
     #logging.info(f"Received vegaSpec from generate_chart: {text_response}")
 
-    if not validate_vega_lite_spec(vega_spec):
+    if summary and vega_spec:
+        try:
+            with span("chart_data"):
+                df = await run_blocking(dataset_store.get, current_dataset.get(), columns=chart_fields(vega_spec) or None)
+                vega_spec = await run_blocking(fill_chart_data, vega_spec, df)
+        except (ChartDataError, KeyError, TypeError) as e:
+            logging.error(f"Could not build chart data: {e!r}")
+            return QueryResponse(response="There was an issue generating the visualization, please try again.", vegaSpec={})
+
+    with span("vega_validation"):
+        is_valid = await run_blocking(validate_vega_lite_spec, vega_spec)
+    if not is_valid:
         return QueryResponse(
         response="This task doesn't require chart generation. Returning an empty Vega-Lite specification.",
         vegaSpec={},
@@ -212,34 +346,30 @@ def sanitize_input(query: str) -> str:
     query = re.sub(r"(\s|`)*$", "", query)
     return query
 
-def execute_panda_dataframe_code(code):
+async def execute_panda_dataframe_code(code):
     """
     Execute the given python code and return the output. 
     References:
     1. https://github.com/langchain-ai/langchain-experimental/blob/main/libs/experimental/langchain_experimental/utilities/python.py
     2. https://github.com/langchain-ai/langchain-experimental/blob/main/libs/experimental/langchain_experimental/tools/python/tool.py
+    The code runs in a pooled worker process with its own output capture, a timeout and a memory limit.
     """
-    # Save the current standard output to restore later
-    old_stdout = sys.stdout
-    # Redirect standard output to a StringIO object to capture any output generated by the code execution
-    sys.stdout = mystdout = StringIO()
-    try:
-        # Execute the provided code within the current environment
-        cleaned_command = sanitize_input(code)
-        exec(cleaned_command)
-                
-        # Restore the original standard output after code execution
-        sys.stdout = old_stdout
-                        
-        # Return any captured output from the executed code
-        return mystdout.getvalue()
-    except Exception as e:
-        sys.stdout = old_stdout
-        return repr(e)
+    cleaned_command = sanitize_input(code)
+    dataset_id = current_dataset.get()
+    dataset = (dataset_id, dataset_store.path(dataset_id)) if dataset_id else None
+    with span("code_execution"):
+        return await run_blocking(
+            code_pool.execute, cleaned_command, dataset, timeout=remaining_time(code_pool.timeout), executor=code_executor,
+        )
 
-def data_analysis_code(data, task):
-    print("entered data_analysis_code function")
+async def data_analysis_code(data, task):
+    logging.debug("entered data_analysis_code function")
+    summary = await dataset_summary()
+    if summary:
+        data = summary
     code_prompt = f"Generate python code to perform the following task: {task} using the data {data}. Print the result using python print(result). The python code should only be used for calculations presented by text instead of data visualizations."
+    if summary:
+        code_prompt += " The full dataset is already loaded as a pandas DataFrame named df. Compute the result from df and do not write the data into the code."
     system_prompt = f"""You are an AI assistant who is an expert in producing code.
         Output python code that can solve the task from the input prompt, taking the following steps.
         1. Collect needed information. Produce code that will output the information needed to perform the task. After sufficient information is printed, the task can be solved based off of mathematics and language skills.
@@ -257,28 +387,32 @@ def data_analysis_code(data, task):
         If the task is not solved correctly even after the code is produced and executed, approach the task again, collect additional information or try solving the task in a different way.
         All vega lite specification generated should not be displayed to the user.
         """
-    logging.info(f"put prompts into ai")
-    response = client.beta.chat.completions.parse(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": code_prompt}
-        ],
-        response_format=CodeResponse
-    )
+    logging.debug(f"put prompts into ai")
+    with span("llm", CODE_MODEL):
+        response = await openai_call(
+            client.beta.chat.completions.parse,
+            model=CODE_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": code_prompt}
+            ],
+            response_format=CodeResponse
+        )
+    record_usage(CODE_MODEL, response.usage)
     
     code = response.choices[0].message.parsed.code
-    logging.info(f"Received code from chat: {code}")
+    log_payload("Received code from chat", code)
     return code
 
 # print msg in red, accept multiple strings like print statement
+# only for sampled requests, and truncated
 def print_red(*strings):
-    print("\033[91m" + " ".join(strings) + "\033[0m")
+    log_payload("\033[91magent\033[0m", " ".join(strings))
 
 
 # print msg in blue, , accept multiple strings like print statement
 def print_blue(*strings):
-    print("\033[94m" + " ".join(strings) + "\033[0m")
+    log_payload("\033[94magent\033[0m", " ".join(strings))
 
 tool_map = {
     "generate_chart": generate_chart,
@@ -289,47 +423,172 @@ tool_map = {
 tool_list = [generate_chart, data_analysis_code, execute_panda_dataframe_code]
 tool_names = [tool.__name__ for tool in tool_list]
 
-def query(question, system_prompt, tools, tool_map, max_iterations=10):
+def tool_result_text(output):
+    """Tool output as text for the model. Chart data values are left out, the model only needs the spec."""
+    if isinstance(output, QueryResponse) and isinstance(output.vegaSpec.get("data", {}).get("values"), list):
+        points = len(output.vegaSpec["data"]["values"])
+        spec = {**output.vegaSpec, "data": {"values": f"{points} data points"}}
+        return str(QueryResponse(response=output.response, vegaSpec=spec))
+    return str(output)
+
+def record_usage(model, usage):
+    """Count the tokens of an OpenAI call in the metrics and against the request's budget."""
+    record_token_usage(model, usage)
+    spend_tokens(usage)
+
+async def call_tool(name, arguments, tool_map):
+    """
+    Run one tool with a timeout. Errors are returned as the tool's output,
+    so one failing tool doesn't discard the results of the others in the same turn.
+    """
+    try:
+        if arguments is None:
+            raise ValueError("Tool arguments are not valid JSON")
+        function_to_call = tool_map[name]
+        if asyncio.iscoroutinefunction(function_to_call):
+            call = function_to_call(**arguments)
+        else:
+            call = run_blocking(function_to_call, **arguments)
+        with span("tool", name):
+            return await asyncio.wait_for(call, timeout=remaining_time(TOOL_TIMEOUT_SECONDS))
+    except asyncio.TimeoutError:
+        logging.error(f"Tool {name} timed out after {TOOL_TIMEOUT_SECONDS}s")
+        return repr(TimeoutError(f"{name} did not finish within {TOOL_TIMEOUT_SECONDS} seconds"))
+    except Exception as e:
+        logging.error(f"Tool {name} failed: {e!r}")
+        return repr(e)
+
+async def stream_chat_completion(**kwargs):
+    """
+    Streaming chat completion. Yields each text delta as a string as soon as it
+    arrives, then the assembled ChatCompletionMessage (tool calls included) last.
+    """
+    content = []
+    tool_calls = {}
+    start = time.perf_counter()
+    stream = await openai_call(client.chat.completions.create, stream=True, stream_options={"include_usage": True}, **kwargs)
+    async for chunk in stream:
+        check_budget()
+        #the usage arrives in a last chunk without choices
+        if chunk.usage is not None:
+            record_usage(kwargs["model"], chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+            yield delta.content
+        for tool_call in delta.tool_calls or []:
+            call = tool_calls.setdefault(
+                tool_call.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+            )
+            if tool_call.id:
+                call["id"] = tool_call.id
+            if tool_call.function and tool_call.function.name:
+                call["function"]["name"] += tool_call.function.name
+            if tool_call.function and tool_call.function.arguments:
+                call["function"]["arguments"] += tool_call.function.arguments
+    observe_span("llm", kwargs["model"], time.perf_counter() - start)
+    yield ChatCompletionMessage.model_validate({
+        "role": "assistant",
+        "content": "".join(content) if content else None,
+        "tool_calls": [tool_calls[index] for index in sorted(tool_calls)] or None,
+    })
+
+async def agent_events(question, system_prompt, tools, tool_map, max_iterations=10, stream=False, messages=None):
+    """
+    Run the tool calling loop and yield (event, data) pairs as it progresses:
+    "token" for streamed LLM text (only when stream=True), "tool_call" and "tool_result"
+    around each tool, "chart" as soon as generate_chart returns a spec, and a final
+    "result" carrying what query() returns.
+    `messages` is the conversation so far, starting with the system prompt. The
+    question and everything the agent adds in this turn are appended to it.
+    """
     # print("dd",pd.read_csv('static/uploads/cars-w-year.csv').head())
-    messages = [{"role": "system", "content": system_prompt}]
+    if messages is None:
+        messages = [{"role": "system", "content": system_prompt}]
     messages.append({"role": "user", "content": question})
     vegaSpec = {}
     i = 0
     while i < max_iterations:
         i += 1
-        print("iteration:", i)
+        logging.debug(f"iteration: {i}")
+        iteration_start = time.perf_counter()
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini", temperature=0.0, messages=messages, tools=tools
-            )
+            if stream:
+                async for item in stream_chat_completion(
+                    model=AGENT_MODEL, temperature=0.0, messages=messages, tools=tools
+                ):
+                    if isinstance(item, str):
+                        yield "token", {"text": item}
+                    else:
+                        message = item
+            else:
+                with span("llm", AGENT_MODEL):
+                    response = await openai_call(
+                        client.chat.completions.create,
+                        model=AGENT_MODEL, temperature=0.0, messages=messages, tools=tools
+                    )
+                record_usage(AGENT_MODEL, response.usage)
+                message = response.choices[0].message
+        except (BudgetExceeded, CircuitOpen):
+            raise
         except Exception as e:
-            print(f"Error during API call: {e}")
-            return None
-        # print(response.choices[0].message)
-        if response.choices[0].message.content != None:
-            print_red(response.choices[0].message.content)
+            logging.error(f"Error during API call: {e}")
+            yield "result", None
+            return
+        # print(message)
+        if message.content != None:
+            print_red(message.content)
 
         # if not function call
-        if response.choices[0].message.tool_calls == None:
-            print("not function call")
+        if message.tool_calls == None:
+            logging.debug("not function call")
+            messages.append(message.model_dump(exclude_none=True))
+            observe_span("agent_iteration", AGENT_MODEL, time.perf_counter() - iteration_start)
             break
 
         # if function call
-        messages.append(response.choices[0].message)
-        for tool_call in response.choices[0].message.tool_calls:
+        messages.append(message.model_dump(exclude_none=True))
+        # tool calls from one turn don't depend on each other, so run them all at once
+        all_arguments = []
+        tasks = []
+        for tool_call in message.tool_calls:
             print_blue("calling:", tool_call.function.name, "with", tool_call.function.arguments)
-            # call the function
-            arguments = json.loads(tool_call.function.arguments)
+            try:
+                arguments = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError:
+                arguments = None
+            all_arguments.append(arguments)
+            tasks.append(asyncio.ensure_future(call_tool(tool_call.function.name, arguments, tool_map)))
+            yield "tool_call", {"id": tool_call.id, "name": tool_call.function.name, "arguments": arguments}
 
-
-            function_to_call = tool_map[tool_call.function.name]
-            output = function_to_call(**arguments)
-            if tool_call.function.name == "generate_chart":
+        try:
+            # report each result as soon as its tool finishes
+            positions = {task: position for position, task in enumerate(tasks)}
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=positions.get):
+                    tool_call = message.tool_calls[positions[task]]
+                    output = task.result()
+                    if tool_call.function.name == "generate_chart" and isinstance(output, QueryResponse):
+                        yield "chart", {"vegaSpec": output.vegaSpec}
+                    yield "tool_result", {"id": tool_call.id, "name": tool_call.function.name, "result": tool_result_text(output)}
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # add the results to the history in the order the model asked for them
+        for tool_call, arguments, task in zip(message.tool_calls, all_arguments, tasks):
+            output = task.result()
+            if tool_call.function.name == "generate_chart" and isinstance(output, QueryResponse):
                 vegaSpec = output.vegaSpec
-                print(vegaSpec)
 
             # create a message containing the result of the function call
-            result_content = json.dumps({**arguments, "result": str(output)})
+            # the data argument is left out, the model already has it in its own tool call
+            echoed_arguments = {key: value for key, value in (arguments or {}).items() if key != "data"}
+            result_content = json.dumps({**echoed_arguments, "result": tool_result_text(output)})
             function_call_result_message = {
                 "role": "tool",
                 "content": result_content,
@@ -338,24 +597,21 @@ def query(question, system_prompt, tools, tool_map, max_iterations=10):
             print_blue("action result:", result_content)
 
             messages.append(function_call_result_message)
-        if i == max_iterations and response.choices[0].message.tool_calls != None:
+        observe_span("agent_iteration", AGENT_MODEL, time.perf_counter() - iteration_start)
+        if i == max_iterations and message.tool_calls != None:
             print_red("Max iterations reached")
-            return "The tool agent could not complete the task in the given time. Please try again."
-    return QueryResponse(response=response.choices[0].message.content, vegaSpec=vegaSpec)
-
-# Endpoint to interact with OpenAI API via LangChain
-@app.post("/query", response_model=QueryResponse)
-async def query_openai(request: QueryRequest):
-    logging.info(f"Received request: {request}")  # Log the whole request object
-    try:
-    
-        if request.sample_data == "":
-            return QueryResponse(response="Please provide a valid CSV data", vegaSpec={})
-        prompt = f'''
-            User prompt: {request.prompt}
-            Data Sample: {request.sample_data}
-        '''
-        function_calling_prompt = f'''
+            yield "result", "The tool agent could not complete the task in the given time. Please try again."
+            return
+    yield "result", QueryResponse(response=message.content, vegaSpec=vegaSpec)
+
+async def query(question, system_prompt, tools, tool_map, max_iterations=10, messages=None):
+    result = None
+    async for event, data in agent_events(question, system_prompt, tools, tool_map, max_iterations, messages=messages):
+        if event == "result":
+            result = data
+    return result
+
+function_calling_prompt = f'''
             You are a helpful assistant. Use the supplied tools to assist the user. 
             Determine if the user's question is relevant to the data provided. If not, return: "Please provide a prompt that is relevant to the dataset" as an explanation as well as an empty vega-lite JSON specification. 
             If the prompt is relevant to the dataset,
@@ -365,10 +621,317 @@ async def query_openai(request: QueryRequest):
             All visualization tasks should be done with the provided tool to return a vega lite specification, and not through code.  
             All vega lite specification generated should not be displayed to the user. Any summary table requests should contain data visually pleasingly in the response variable.
             '''
-        return query(prompt, function_calling_prompt, tools, tool_map)
+
+def conversation_prefix(data_prompt):
+    """
+    Messages every conversation on the same data starts with. They come before the
+    question and are the same bytes on every request, so provider-side prompt caching
+    can reuse them across questions and across the turns of a session.
+    """
+    return [
+        {"role": "system", "content": function_calling_prompt},
+        {"role": "system", "content": data_prompt},
+    ]
+
+async def prepare_query(request: QueryRequest):
+    """
+    Build the agent prompt and the response cache key for a request.
+    Returns (prefix, question, cache_key, None), or (None, None, None, response) when the request has no usable data.
+    """
+    data_prompt = f"Data Sample: {request.sample_data}"
+    if request.dataset_id:
+        current_dataset.set(request.dataset_id)
+        try:
+            data_prompt = f"Data Summary: {await dataset_summary()}"
+        except DatasetNotFound:
+            return None, None, None, QueryResponse(response="The uploaded data could not be found, please upload the CSV file again", vegaSpec={})
+    elif request.sample_data == "":
+        return None, None, None, QueryResponse(response="Please provide a valid CSV data", vegaSpec={})
+    question = f"User prompt: {request.prompt}"
+    #Same question on the same data and models gets the same answer
+    dataset_fingerprint = request.dataset_id or hashlib.sha256(request.sample_data.encode("utf-8")).hexdigest()
+    cache_key = make_cache_key(
+        request.prompt, dataset_fingerprint, [AGENT_MODEL, CHART_MODEL, CODE_MODEL], function_calling_prompt,
+    )
+    return conversation_prefix(data_prompt), question, cache_key, None
+
+async def fast_path_answer(request: QueryRequest, prefix, question):
+    """
+    Answer for simple stats questions on a stored dataset, computed directly on the
+    DataFrame, or None when the question needs the agent. Follow-ups in a chat session
+    always do, they may refer to earlier turns ("only look at Japanese cars").
+    """
+    if not FAST_PATH or not request.dataset_id or is_follow_up(request, prefix):
+        return None
+    with span("fast_path"):
+        columns = await run_blocking(dataset_store.columns, request.dataset_id)
+        df = await run_blocking(dataset_store.get, request.dataset_id, columns=question_columns(request.prompt, columns))
+        answer = await run_blocking(answer_simple_question, request.prompt, df)
+    FAST_PATH_QUERIES.inc(outcome="answered" if answer else "agent")
+    if answer is None:
+        return None
+    if request.session_id:
+        add_answer_turn(request, prefix, question, answer)
+    return QueryResponse(response=answer, vegaSpec={})
+
+def add_answer_turn(request: QueryRequest, prefix, question, answer):
+    #Keep an answer computed outside the agent loop in the history so follow-ups can refer to it
+    chat_sessions.get(request.session_id, prefix).add_turn(
+        [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+    )
+
+def is_follow_up(request: QueryRequest, prefix) -> bool:
+    """
+    Whether the request continues a chat session that already has turns. Only those
+    answers depend on more than the fixed prefix, so only they bypass the response cache.
+    """
+    return bool(request.session_id) and bool(chat_sessions.get(request.session_id, prefix).turns)
+
+async def session_query_events(request: QueryRequest, prefix, question, stream=False):
+    """
+    agent_events for a request in a chat session: runs on the session's history and
+    adds the turn to it once it finishes. Turns of one session run one at a time.
+    """
+    session = chat_sessions.get(request.session_id, prefix)
+    async with session.lock:
+        messages = session.messages()
+        start = len(messages)
+        async for event, data in agent_events(question, function_calling_prompt, tools, tool_map, stream=stream, messages=messages):
+            if event == "result" and isinstance(data, QueryResponse):
+                session.add_turn(messages[start:])
+            yield event, data
+
+async def session_query(request: QueryRequest, prefix, question):
+    """query() for a request in a chat session, see session_query_events."""
+    result = None
+    async for event, data in session_query_events(request, prefix, question):
+        if event == "result":
+            result = data
+    return result
+
+BUSY_MESSAGE = "The server is busy, please try again in a moment."
+BUDGET_MESSAGE = "This question needed more time or tokens than allowed, please try a simpler question."
+
+@asynccontextmanager
+async def query_slot():
+    """
+    One of the MAX_CONCURRENT_QUERIES agent slots. Fails fast with CircuitOpen while
+    OpenAI is known to be down, and with Overloaded when no slot frees up in time.
+    """
+    if openai_breaker.state == "open":
+        raise CircuitOpen("OpenAI calls are paused")
+    try:
+        await asyncio.wait_for(query_semaphore.acquire(), timeout=QUERY_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise Overloaded(f"no query slot free within {QUERY_QUEUE_TIMEOUT_SECONDS}s")
+    try:
+        yield
+    finally:
+        query_semaphore.release()
+
+async def until_disconnected(http_request: Request, awaitable):
+    """
+    Await `awaitable`, cancelling it when the client goes away (ClientDisconnected)
+    or the request's deadline passes (BudgetExceeded).
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                raise ClientDisconnected()
+            check_budget()
+    finally:
+        task.cancel()
+
+def rejection_reason(e):
+    return {BudgetExceeded: "budget_exceeded", CircuitOpen: "circuit_open", Overloaded: "overloaded"}[type(e)]
+
+# Endpoint to interact with OpenAI API via LangChain
+@app.post("/query", response_model=QueryResponse)
+async def query_openai(request: QueryRequest, http_request: Request):
+    log_payload("Received request", request)  # Log the whole request object for sampled requests
+    start_request_budget()
+    try:
+        prefix, question, cache_key, early_response = await prepare_query(request)
+        if early_response is not None:
+            return early_response
+
+        fast_response = await fast_path_answer(request, prefix, question)
+        if fast_response is not None:
+            return fast_response
+
+        computed = False
+
+        async def run_query():
+            nonlocal computed
+            computed = True
+            async with query_slot():
+                if request.session_id:
+                    result = await session_query(request, prefix, question)
+                else:
+                    result = await query(question, function_calling_prompt, tools, tool_map, messages=prefix)
+            return result.model_dump() if isinstance(result, QueryResponse) else result
+
+        if is_follow_up(request, prefix):
+            #Answers to follow-ups depend on the conversation so far, so they bypass the response cache
+            result = await until_disconnected(http_request, run_query())
+        else:
+            #Identical requests in flight share one run, it is cancelled once all of their clients are gone
+            result = await until_disconnected(
+                http_request,
+                response_cache.get_or_compute(cache_key, run_query, cacheable=lambda value: isinstance(value, dict)),
+            )
+            if request.session_id and not computed and isinstance(result, dict):
+                #Answered from the cache or by another request's run, it still starts this session's history
+                add_answer_turn(request, prefix, question, result["response"])
+        if isinstance(result, dict):
+            return QueryResponse(**result)
+        return QueryResponse(response=result or "An error occurred. Please try again", vegaSpec={})
+    except BudgetExceeded:
+        REJECTED_REQUESTS.inc(reason="budget_exceeded")
+        return QueryResponse(response=BUDGET_MESSAGE, vegaSpec={})
+    except (CircuitOpen, Overloaded) as e:
+        REJECTED_REQUESTS.inc(reason=rejection_reason(e))
+        retry_after = max(1, round(openai_breaker.retry_after()))
+        raise HTTPException(status_code=503, detail=BUSY_MESSAGE, headers={"Retry-After": str(retry_after)})
+    except ClientDisconnected:
+        REJECTED_REQUESTS.inc(reason="client_disconnected")
+        #Nobody reads this, 499 is the usual status for requests the client closed
+        return Response(status_code=499)
     except Exception as e:
         return QueryResponse(response="An error occurred. Please try again", vegaSpec={})
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def query_stream_events(request: QueryRequest):
+    """
+    Server-Sent Events for /query/stream: token, tool_call, tool_result and chart events
+    while the agent runs, then one done event whose data has the QueryResponse fields.
+    """
+    error_response = QueryResponse(response="An error occurred. Please try again", vegaSpec={})
+    start_request_budget()
+    try:
+        prefix, question, cache_key, early_response = await prepare_query(request)
+        if early_response is not None:
+            yield sse_event("done", early_response.model_dump())
+            return
+
+        fast_response = await fast_path_answer(request, prefix, question)
+        if fast_response is not None:
+            yield sse_event("done", fast_response.model_dump())
+            return
+
+        if is_follow_up(request, prefix):
+            #Answers to follow-ups depend on the conversation so far, so they bypass the response cache
+            cache_key = None
+        if request.session_id:
+            events = session_query_events(request, prefix, question, stream=True)
+        else:
+            events = agent_events(question, function_calling_prompt, tools, tool_map, stream=True, messages=prefix)
+
+        #A cached answer, or that of an identical request already running; else this request runs the agent
+        cached, flight = await response_cache.get_or_lead(cache_key) if cache_key else (None, None)
+        if cached is not None:
+            if request.session_id:
+                add_answer_turn(request, prefix, question, cached["response"])
+            if cached["vegaSpec"]:
+                yield sse_event("chart", {"vegaSpec": cached["vegaSpec"]})
+            yield sse_event("done", cached)
+            return
+
+        result = None
+        try:
+            async with query_slot():
+                async for event, data in events:
+                    if event == "result":
+                        result = data
+                    else:
+                        yield sse_event(event, data)
+        finally:
+            if flight is not None:
+                #Requests waiting for this run get its answer, or run the agent themselves if it failed
+                response_cache.complete(flight, result.model_dump() if isinstance(result, QueryResponse) else None)
+    except (BudgetExceeded, CircuitOpen, Overloaded) as e:
+        message = BUDGET_MESSAGE if isinstance(e, BudgetExceeded) else BUSY_MESSAGE
+        REJECTED_REQUESTS.inc(reason=rejection_reason(e))
+        yield sse_event("done", QueryResponse(response=message, vegaSpec={}).model_dump())
+        return
+    except asyncio.CancelledError:
+        #StreamingResponse cancels the generator when the client disconnects
+        REJECTED_REQUESTS.inc(reason="client_disconnected")
+        raise
+    except Exception as e:
+        logging.error(f"Streaming query failed: {e}")
+        yield sse_event("done", error_response.model_dump())
+        return
+
+    if isinstance(result, QueryResponse):
+        if cache_key:
+            await response_cache.set(cache_key, result.model_dump())
+        yield sse_event("done", result.model_dump())
+    elif isinstance(result, str):
+        yield sse_event("done", QueryResponse(response=result, vegaSpec={}).model_dump())
+    else:
+        yield sse_event("done", error_response.model_dump())
+
+# Streaming variant of /query, sends progress as Server-Sent Events
+@app.post("/query/stream")
+async def query_openai_stream(request: QueryRequest):
+    log_payload("Received streaming request", request)
+    return StreamingResponse(
+        query_stream_events(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Endpoint to upload a CSV file once, later queries refer to it by dataset_id
+@app.post("/upload", response_model=UploadResponse)
+async def upload_csv(file: UploadFile = File(...)):
+    if not (file.filename or "").endswith(".csv"):
+        raise HTTPException(status_code=400, detail="Please upload a valid CSV file.")
+    try:
+        dataset_id = await run_blocking(dataset_store.put_csv, file.file)
+        rows, columns = await run_blocking(dataset_store.info, dataset_id)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        logging.error(f"Could not parse uploaded CSV: {e}")
+        raise HTTPException(status_code=400, detail="Please upload a valid CSV file.")
+    return UploadResponse(
+        dataset_id=dataset_id,
+        rows=rows,
+        columns=[ColumnInfo(name=name, type=dtype) for name, dtype in columns],
+    )
+
+# Hit/miss counters of the /query response cache
+@app.get("/cache/stats")
+async def cache_stats():
+    return response_cache.stats()
+
+# Number of chat sessions and the size of their history
+@app.get("/sessions/stats")
+async def session_stats():
+    return chat_sessions.stats()
+
+def response_cache_metrics():
+    stats = response_cache.stats()
+    lines = []
+    for name in ("hits", "misses", "coalesced", "evictions"):
+        lines.append(f"# TYPE humanai_response_cache_{name}_total counter")
+        lines.append(f"humanai_response_cache_{name}_total {stats[name]}")
+    lines.append("# TYPE humanai_response_cache_in_flight gauge")
+    lines.append(f"humanai_response_cache_in_flight {stats['in_flight']}")
+    return lines
+
+register_collector(response_cache_metrics)
+
+# Prometheus metrics: request, LLM, tool, validation and code execution timings and token counts
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 # Root endpoint
 @app.get("/")
 async def read_root():
@@ -0,0 +1,75 @@
+import pandas as pd
+
+#Quantiles reported for numeric and datetime columns
+PROFILE_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+#Most frequent values reported for each column
+PROFILE_TOP_K = 5
+#Long strings are cut so one wide text column can't blow up the prompt
+MAX_VALUE_CHARS = 40
+
+
+def _clean(value):
+    """Turn numpy/pandas scalars into plain JSON values."""
+    if value is None or (not isinstance(value, (list, dict, str)) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, str) and len(value) > MAX_VALUE_CHARS:
+        return value[:MAX_VALUE_CHARS] + "..."
+    return value
+
+
+def profile_dataframe(df: pd.DataFrame, top_k=PROFILE_TOP_K, quantiles=PROFILE_QUANTILES) -> dict:
+    """
+    Compact per-column summary of a DataFrame: dtype, null count, cardinality,
+    min/max, quantiles and most frequent values.
+    Its size depends on the number of columns, not rows.
+    """
+    nulls = df.isna().sum()
+    unique = df.nunique(dropna=True)
+
+    numeric = df.select_dtypes(include=["number", "datetime"]).columns.drop(
+        df.select_dtypes(include=["bool"]).columns, errors="ignore"
+    )
+    mins = df[numeric].min() if len(numeric) else pd.Series(dtype=object)
+    maxs = df[numeric].max() if len(numeric) else pd.Series(dtype=object)
+    qs = df[numeric].quantile(list(quantiles)) if len(numeric) else pd.DataFrame()
+
+    columns = []
+    for name in df.columns:
+        column = {
+            "name": str(name),
+            "dtype": str(df[name].dtype),
+            "nulls": int(nulls[name]),
+            "unique": int(unique[name]),
+        }
+        if name in numeric:
+            column["min"] = _clean(mins[name])
+            column["max"] = _clean(maxs[name])
+            column["quantiles"] = {str(q): _clean(qs.at[q, name]) for q in quantiles}
+        #Skip identifier-like columns where every value is distinct
+        if (name not in numeric or unique[name] <= top_k) and unique[name] < len(df):
+            counts = df[name].value_counts(dropna=True).head(top_k)
+            column["top"] = [[_clean(value), int(count)] for value, count in counts.items()]
+        columns.append(column)
+
+    return {"rows": int(len(df)), "columns": columns}
+
+
+def format_profile(profile: dict) -> str:
+    """Render a profile as short text lines, one per column, for use in prompts."""
+    lines = [f"{profile['rows']} rows, {len(profile['columns'])} columns. Available as pandas DataFrame df."]
+    for column in profile["columns"]:
+        parts = [f"{column['name']} ({column['dtype']})", f"nulls={column['nulls']}", f"unique={column['unique']}"]
+        if "min" in column:
+            parts.append(f"min={column['min']}")
+            parts.append(f"max={column['max']}")
+            parts.append("quantiles=" + ", ".join(f"p{int(float(q) * 100)}={v}" for q, v in column["quantiles"].items()))
+        if "top" in column:
+            parts.append("top=" + ", ".join(f"{value!r}:{count}" for value, count in column["top"]))
+        lines.append("- " + "; ".join(parts))
+    return "\n".join(lines)
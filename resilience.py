@@ -0,0 +1,217 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from contextvars import ContextVar
+
+import openai
+
+from telemetry import Counter
+
+#Wall-clock limit for one /query request, agent loop, tools and retries included
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", "120"))
+#OpenAI tokens (prompt and completion) one request may use
+REQUEST_TOKEN_BUDGET = int(os.environ.get("REQUEST_TOKEN_BUDGET", "100000"))
+#Upper bound for max_tokens on a single completion, whatever is left of the budget
+OPENAI_MAX_COMPLETION_TOKENS = int(os.environ.get("OPENAI_MAX_COMPLETION_TOKENS", "4096"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE_SECONDS = float(os.environ.get("OPENAI_BACKOFF_BASE_SECONDS", "0.5"))
+OPENAI_BACKOFF_MAX_SECONDS = float(os.environ.get("OPENAI_BACKOFF_MAX_SECONDS", "8"))
+#Consecutive failed OpenAI calls that open the circuit, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", "30"))
+
+#Errors worth another attempt: rate limits, 5xx responses, timeouts and dropped connections
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+OPENAI_RETRIES = Counter("humanai_openai_retries_total", "OpenAI calls retried after a transient error.", ["error"])
+REJECTED_REQUESTS = Counter(
+    "humanai_rejected_requests_total",
+    "Requests stopped early: overloaded, circuit_open, budget_exceeded or client_disconnected.",
+    ["reason"],
+)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class RequestBudget:
+    """Deadline and token allowance of one request, shared by all its OpenAI calls and tools."""
+
+    def __init__(self, timeout=REQUEST_TIMEOUT_SECONDS, tokens=REQUEST_TOKEN_BUDGET):
+        self.deadline = time.monotonic() + timeout
+        self.tokens_left = tokens
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise BudgetExceeded("request deadline reached")
+        if self.tokens_left <= 0:
+            raise BudgetExceeded("request token budget used up")
+
+    def spend(self, usage):
+        if usage is not None:
+            self.tokens_left -= (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)
+
+
+current_budget = ContextVar("current_budget", default=None)
+
+
+def start_request_budget(timeout=REQUEST_TIMEOUT_SECONDS, tokens=REQUEST_TOKEN_BUDGET):
+    budget = RequestBudget(timeout, tokens)
+    current_budget.set(budget)
+    return budget
+
+
+def remaining_time(default):
+    """Seconds left for the current request, at most `default`. Raises BudgetExceeded when none are left."""
+    budget = current_budget.get()
+    if budget is None:
+        return default
+    budget.check()
+    return min(default, budget.remaining()) if default is not None else budget.remaining()
+
+
+def check_budget():
+    budget = current_budget.get()
+    if budget is not None:
+        budget.check()
+
+
+def spend_tokens(usage):
+    budget = current_budget.get()
+    if budget is not None:
+        budget.spend(usage)
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency. After `threshold` consecutive failures
+    calls are refused for `reset_seconds`, then one trial call decides whether
+    the circuit closes again.
+    """
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic()) if self.opened_at is not None else 0.0
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self._trial_running):
+            raise CircuitOpen(f"OpenAI calls paused for {self.retry_after():.0f}s after repeated failures")
+        if state == "half_open":
+            self._trial_running = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_running or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.error(f"Opening the OpenAI circuit after {self.failures} failures")
+            self.opened_at = time.monotonic()
+        self._trial_running = False
+
+    def record_ignored(self):
+        """The call failed for a reason that says nothing about the service's health."""
+        self._trial_running = False
+
+
+openai_breaker = CircuitBreaker()
+
+
+def backoff_delay(attempt, error=None, base=OPENAI_BACKOFF_BASE_SECONDS, cap=OPENAI_BACKOFF_MAX_SECONDS):
+    """Full-jitter exponential backoff, or the server's Retry-After when it sent one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), cap)
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def rate_limited(error) -> bool:
+    """A 429 that said when to come back: the service is pacing us, not failing."""
+    response = getattr(error, "response", None)
+    return isinstance(error, openai.RateLimitError) and response is not None and bool(response.headers.get("retry-after"))
+
+
+async def openai_call(method, breaker=openai_breaker, max_retries=OPENAI_MAX_RETRIES, **kwargs):
+    """
+    Call an OpenAI client method within the current request's budget: the call gets
+    the remaining time as its timeout and at most the remaining tokens as max_tokens.
+    Rate limits, 5xx responses and connection errors are retried with jittered
+    exponential backoff. The call as a whole, retries included, counts once for the
+    circuit breaker, and only when it fails for a reason other than rate limiting.
+    """
+    budget = current_budget.get()
+    attempt = 0
+    breaker.before_call()
+    while True:
+        try:
+            if budget is not None:
+                budget.check()
+                kwargs["timeout"] = budget.remaining()
+                kwargs["max_tokens"] = max(1, min(OPENAI_MAX_COMPLETION_TOKENS, budget.tokens_left))
+            result = await method(**kwargs)
+        except RETRYABLE_ERRORS as e:
+            if budget is not None and isinstance(e, openai.APITimeoutError) and budget.remaining() <= 0:
+                #Timed out because the request ran out of time, not because the service is unhealthy
+                breaker.record_ignored()
+                raise BudgetExceeded("request deadline reached") from e
+            delay = backoff_delay(attempt, e)
+            no_time_left = budget is not None and delay >= budget.remaining()
+            if attempt >= max_retries or no_time_left:
+                if rate_limited(e):
+                    breaker.record_ignored()
+                else:
+                    breaker.record_failure()
+                if no_time_left and attempt < max_retries:
+                    raise BudgetExceeded("no time left to retry") from e
+                raise
+            OPENAI_RETRIES.inc(error=type(e).__name__)
+            logging.warning(f"OpenAI call failed with {type(e).__name__}, retrying in {delay:.2f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            #Errors of the request itself (bad request, cancellation, budget) say nothing about the service
+            breaker.record_ignored()
+            raise
+        breaker.record_success()
+        return result
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+#"memory" keeps entries in this process, "sqlite" shares them across workers and restarts
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_PATH = os.environ.get(
+    "RESPONSE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "response_cache.sqlite3"),
+)
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation so trivial variations share an entry."""
+    return " ".join(prompt.lower().split()).rstrip("?!. ")
+
+
+def make_cache_key(prompt, dataset_fingerprint, model, *extra) -> str:
+    material = json.dumps([normalize_prompt(prompt), dataset_fingerprint, model, *extra])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    blocking = False
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """Store a value and return how many entries were evicted to make room."""
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteBackend:
+    """
+    Cache entries in a SQLite file. WAL mode lets several uvicorn workers read
+    and write the same file. Values must be JSON serializable.
+    """
+    blocking = True
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def _connection(self):
+        #sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now),
+            )
+            conn.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            evicted = conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        return evicted
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+class ResponseCache:
+    """
+    TTL cache in front of an expensive async computation.
+    Concurrent requests for the same key share one in-flight computation
+    (single-flight). The shared computation is only cancelled once every
+    request waiting on it has gone away.
+    """
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._in_flight = {}
+
+    async def _call(self, func, *args):
+        if self.backend.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    async def get(self, key):
+        """Cached value for `key` or None, counted as a hit or a miss."""
+        value = await self._call(self.backend.get, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key, value):
+        self.evictions += await self._call(self.backend.set, key, value, self.ttl)
+
+    async def get_or_compute(self, key, compute, cacheable=lambda value: value is not None):
+        """
+        Return the cached value for `key`, or await `compute()` and cache its result
+        if `cacheable(result)` is true.
+        """
+        value = await self._call(self.backend.get, key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        entry = self._in_flight.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = {"task": asyncio.ensure_future(self._compute_and_store(key, compute, cacheable)), "waiters": 0}
+            self._in_flight[key] = entry
+            entry["task"].add_done_callback(lambda _, entry=entry: self._forget(key, entry))
+        else:
+            self.coalesced += 1
+        return await self._wait(entry)
+
+    async def get_or_lead(self, key):
+        """
+        Lookup for callers that compute the value themselves, e.g. to stream progress
+        while they do. Returns (value, None) with the cached value or the result of an
+        identical computation in flight, or (None, future) when the caller computes it:
+        it must pass its result (None on failure) to complete(future, value), and the
+        requests waiting for it get that value.
+        """
+        while True:
+            value = await self._call(self.backend.get, key)
+            if value is not None:
+                self.hits += 1
+                return value, None
+            entry = self._in_flight.get(key)
+            if entry is None:
+                self.misses += 1
+                future = asyncio.get_running_loop().create_future()
+                entry = {"task": future, "waiters": 0}
+                self._in_flight[key] = entry
+                future.add_done_callback(lambda _, entry=entry: self._forget(key, entry))
+                return None, future
+            self.coalesced += 1
+            value = await self._wait(entry)
+            if value is not None:
+                return value, None
+            #The computation failed, try again and maybe compute it ourselves
+
+    def complete(self, future, value):
+        if not future.done():
+            future.set_result(value)
+
+    async def _wait(self, entry):
+        entry["waiters"] += 1
+        try:
+            return await asyncio.shield(entry["task"])
+        except asyncio.CancelledError:
+            #Only computations run by the cache belong to their waiters, not those of get_or_lead callers
+            if entry["waiters"] == 1 and isinstance(entry["task"], asyncio.Task) and not entry["task"].done():
+                entry["task"].cancel()
+            raise
+        finally:
+            entry["waiters"] -= 1
+
+    def _forget(self, key, entry):
+        if self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+
+    async def _compute_and_store(self, key, compute, cacheable):
+        value = await compute()
+        if cacheable(value):
+            await self.set(key, value)
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "in_flight": len(self._in_flight),
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+def create_response_cache(backend=RESPONSE_CACHE_BACKEND):
+    if backend == "sqlite":
+        return ResponseCache(SQLiteBackend())
+    if backend == "memory":
+        return ResponseCache(MemoryBackend())
+    raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND: {backend}")
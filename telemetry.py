@@ -0,0 +1,246 @@
+import os
+import time
+import queue
+import random
+import logging
+import threading
+import logging.handlers
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from starlette.datastructures import Headers, MutableHeaders
+
+#Fraction of requests whose full payloads (prompts, completions) are logged
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get("PAYLOAD_LOG_SAMPLE_RATE", "0.01"))
+#Logged payloads are cut to this many characters
+PAYLOAD_LOG_MAX_CHARS = int(os.environ.get("PAYLOAD_LOG_MAX_CHARS", "2000"))
+#Add a Server-Timing header with the per-request breakdown to every response,
+#clients can also ask for it per request with an "X-Timing: 1" header
+TIMING_HEADERS = os.environ.get("TIMING_HEADERS", "0") == "1"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+#Spans recorded during the current request, see span()
+current_trace = ContextVar("current_trace", default=None)
+#Whether this request's payloads are logged, decided once per request
+payload_sampled = ContextVar("payload_sampled", default=False)
+
+_registry = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+
+def register_collector(collect):
+    """`collect()` returns extra exposition lines, for values owned by other modules."""
+    _collectors.append(collect)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    for collect in _collectors:
+        lines += collect()
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "humanai_http_request_duration_seconds", "Time to handle an HTTP request.", ["method", "path", "status"]
+)
+SPAN_SECONDS = Histogram(
+    "humanai_span_duration_seconds",
+    "Time spent in each traced step: agent_iteration, llm, tool, vega_validation, code_execution.",
+    ["span", "detail"],
+)
+SPAN_ERRORS = Counter("humanai_span_errors_total", "Traced steps that raised an exception.", ["span", "detail"])
+LLM_TOKENS = Counter("humanai_llm_tokens_total", "Tokens used by OpenAI calls.", ["model", "kind"])
+FAST_PATH_QUERIES = Counter(
+    "humanai_fast_path_queries_total", "Questions on stored datasets answered by the fast path or passed to the agent.", ["outcome"]
+)
+
+
+def observe_span(name, detail, elapsed):
+    SPAN_SECONDS.observe(elapsed, span=name, detail=detail)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.append((name, detail, elapsed))
+
+
+@contextmanager
+def span(name, detail=""):
+    """
+    Time a block. The duration goes to the span histogram and, when a request
+    trace is active, to that request's timing breakdown.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        SPAN_ERRORS.inc(span=name, detail=detail)
+        raise
+    finally:
+        observe_span(name, detail, time.perf_counter() - start)
+
+
+def record_token_usage(model, usage):
+    if usage is None:
+        return
+    LLM_TOKENS.inc(usage.prompt_tokens or 0, model=model, kind="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens or 0, model=model, kind="completion")
+    #prompt tokens served from the provider's prompt cache
+    details = getattr(usage, "prompt_tokens_details", None)
+    LLM_TOKENS.inc(getattr(details, "cached_tokens", None) or 0, model=model, kind="cached_prompt")
+    trace = current_trace.get()
+    if trace is not None:
+        trace.append(("tokens", model, (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)))
+
+
+def server_timing_header(trace) -> str:
+    """Sum the spans of one request per name, in Server-Timing header format (milliseconds)."""
+    totals = {}
+    counts = {}
+    for name, _, value in trace:
+        if name == "tokens":
+            continue
+        totals[name] = totals.get(name, 0.0) + value
+        counts[name] = counts.get(name, 0) + 1
+    tokens = sum(value for name, _, value in trace if name == "tokens")
+    parts = [f'{name};dur={total * 1000:.1f};desc="{counts[name]}x"' for name, total in totals.items()]
+    if tokens:
+        parts.append(f'tokens;desc="{tokens}"')
+    return ", ".join(parts)
+
+
+def start_request_trace(sample_rate=PAYLOAD_LOG_SAMPLE_RATE):
+    trace = []
+    current_trace.set(trace)
+    payload_sampled.set(random.random() < sample_rate)
+    return trace
+
+
+class RequestTracingMiddleware:
+    """
+    Time each HTTP request and collect its spans, optionally returned as a
+    Server-Timing header. Written as plain ASGI instead of with @app.middleware so
+    the endpoint keeps the original receive channel and can notice disconnects.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace = start_request_trace()
+        start = time.perf_counter()
+        timing_requested = TIMING_HEADERS or Headers(scope=scope).get("x-timing") == "1"
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if trace and timing_requested:
+                    MutableHeaders(scope=message).append("Server-Timing", server_timing_header(trace))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            #Label by route template so metrics don't grow with every distinct URL
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=scope["method"], path=path, status=status)
+
+
+def log_payload(message, payload, max_chars=PAYLOAD_LOG_MAX_CHARS):
+    """Log a large payload only for sampled requests, and never more than `max_chars` of it."""
+    if not payload_sampled.get():
+        return
+    text = str(payload)
+    if len(text) > max_chars:
+        text = f"{text[:max_chars]}... ({len(text)} chars)"
+    logging.info(f"{message}: {text}")
+
+
+def setup_logging(level=logging.INFO):
+    """
+    Route all log records through a queue so that formatting and writing happen on a
+    background thread instead of in the request path.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    return listener
@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import requests
+from jsonschema import validators
+from jsonschema.exceptions import best_match
+
+VEGA_LITE_SCHEMA_URL = "https://vega.github.io/schema/vega-lite/v5.json"
+
+#Bundled copy of the v5 schema (v5.20.1), so validation never needs the network
+VEGA_LITE_SCHEMA_PATH = os.environ.get(
+    "VEGA_LITE_SCHEMA_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas", "vega-lite-v5.json"),
+)
+
+#Number of spec fingerprints whose validation result is remembered
+VALIDATION_CACHE_SIZE = int(os.environ.get("VEGA_LITE_VALIDATION_CACHE_SIZE", "1024"))
+
+_validation_cache = OrderedDict()
+_validation_cache_lock = threading.Lock()
+
+
+def load_vega_lite_schema(path=VEGA_LITE_SCHEMA_PATH, url=VEGA_LITE_SCHEMA_URL):
+    """
+    Load the Vega-Lite schema from disk.
+    If the file is missing it is downloaded once and written to `path`, so later
+    processes start from the on-disk copy.
+    """
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    logging.warning(f"Vega-Lite schema not found at {path}, downloading from {url}")
+    schema = requests.get(url, timeout=30).json()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(schema, f)
+    except OSError as e:
+        logging.warning(f"Could not cache Vega-Lite schema to {path}: {e}")
+    return schema
+
+
+@lru_cache(maxsize=1)
+def get_vega_lite_validator():
+    """Build the schema validator once per process and reuse it for every spec."""
+    schema = load_vega_lite_schema()
+    validator_class = validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+def spec_fingerprint(spec) -> str:
+    """Stable hash of a spec, independent of key order."""
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def validate_vega_lite_spec(spec: dict):
+    key = spec_fingerprint(spec)
+    with _validation_cache_lock:
+        if key in _validation_cache:
+            _validation_cache.move_to_end(key)
+            return _validation_cache[key]
+
+    validator = get_vega_lite_validator()
+    error = best_match(validator.iter_errors(spec))
+    is_valid = error is None
+    if not is_valid:
+        logging.error(f"Vega-Lite spec validation error: {error.message}")
+
+    with _validation_cache_lock:
+        _validation_cache[key] = is_valid
+        _validation_cache.move_to_end(key)
+        while len(_validation_cache) > VALIDATION_CACHE_SIZE:
+            _validation_cache.popitem(last=False)
+    return is_valid
+
+
+def clear_validation_cache():
+    with _validation_cache_lock:
+        _validation_cache.clear()